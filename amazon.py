@@ -1,81 +1,158 @@
-from selenium import webdriver
 from selenium.webdriver.support.ui import Select
-from selenium.common.exceptions import NoSuchElementException
-from bs4 import BeautifulSoup
-import pandas as pd
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 import re
-import time
 import datetime
-import random
 import argparse
+import functools
 import logging
 import json
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from review_classification import predict_labels
+from file_output import open_sink, SINKS
+import rate_limiter
+from state_store import review_key
+from review_records import ReviewBatch, REVIEW_COLUMNS
+from html_parsing import parse_page
+from driver_pool import DriverPool, LazyDriver, new_driver
+from fetch_engine import FetchEngine, host_slot
+import http_session
+import instrumentation
+from pipeline import add_pipeline_arguments, open_pipeline, close_pipeline
 
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+# the model of every review is read from the size it was written for
+EXTRA_COLUMNS = ("Model No.", "Model Description", "Badge")
 TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
 
 
-def extract(soup, models, descriptions, dates, ratings, titles, bodies, images, badges, earliest=None):
+@instrumentation.timed("extract")
+def extract(soup, batch, earliest=None, watermark=None):
     reviews = soup.find_all("div", {"data-hook": "review"})
     for review in reviews:
         date = re.findall("\\S+\\s+\\d+,\\s+\\d+$", review.find("span", {"data-hook": "review-date"}).text)[0]
-        if earliest and datetime.datetime.strptime(date, "%B %d, %Y").date() < earliest:
+        review_date = datetime.datetime.strptime(date, "%B %d, %Y").date()
+        if earliest and review_date < earliest:
             return False
-        dates.append(date)
+        if watermark is not None:
+            key = review.attrs.get("id") or review_key(date, review.text)
+            if watermark.reached(review_date, key):
+                return False
+            watermark.observe(review_date, key)
         size_raw = review.find("a", {"data-hook": "format-strip"})
         size = size_raw.text.replace("Size: ", "") if size_raw else None
         model_no, model_description = size2model.get(size, (size, size))
-        models.append(model_no)
-        descriptions.append(model_description)
         rating = review.find("i", {"data-hook": "review-star-rating"})
-        ratings.append(int(rating.text[0]) if rating else None)
         title = review.find("a", {"data-hook": "review-title"})
-        titles.append(title.text.strip() if title else None)
         body = review.find("span", {"data-hook": "review-body"})
-        bodies.append(body.text.strip() if body else None)
         images_raw = review.find_all("img", {"data-hook": "review-image-tile"})
-        images.append("\n".join(image.attrs["src"] for image in images_raw))
         badge = review.find("span", {"data-hook": "avp-badge"})
-        badges.append(badge.text.strip() if badge else None)
+        batch.add(review_date, int(rating.text[0]) if rating else None, title.text.strip() if title else None,
+                  body.text.strip() if body else None, "\n".join(image.attrs["src"] for image in images_raw),
+                  model_no, model_description, badge.text.strip() if badge else None)
     return True
 
 
-def parse_product(driver, url, model=None, day_lim=None):
-    driver.get(url)
+def is_verification(page):
+    return "/errors/validateCaptcha" in page
+
+
+def load_page(driver, limiter, interactive=True):
+    page = driver.page_source
+    if is_verification(page):
+        limiter.report_blocked()
+        # nobody can complete the verification in a headless browser, so the product fails instead of waiting
+        if not interactive:
+            raise RuntimeError("Verification page in Chrome: {}".format(driver.current_url))
+        _ = input("Complete verification and press ENTER to proceed")
+        page = driver.page_source
+    else:
+        limiter.report()
+    return parse_page(page, "amazon")
+
+
+@instrumentation.timed_product("amazon", 1)
+def parse_product(driver, url, model=None, day_lim=None, watermark=None, interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    limiter.acquire()
+    with instrumentation.timer("browser_load"):
+        driver.get(url)
     prev_url = driver.current_url
-    time.sleep(2 + random.random())
+    limiter.acquire()
+    load_page(driver, limiter, interactive)
     try:
         drop_down = Select(driver.find_element_by_class_name("a-native-dropdown.a-declarative"))
     except NoSuchElementException:
         return None
     drop_down.select_by_value("recent")
-    time.sleep(1 + random.random())
-    soup = BeautifulSoup(driver.page_source, "html.parser")
+    limiter.acquire()
+    soup = parse_page(driver.page_source, "amazon")
     earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
-    models, descriptions, dates, ratings, titles, bodies, images, badges = [], [], [], [], [], [], [], []
-    to_continue = extract(soup, models, descriptions, dates, ratings, titles, bodies, images, badges, earliest)
+    batch = ReviewBatch(EXTRA_COLUMNS)
+    to_continue = extract(soup, batch, earliest, watermark)
 
     while to_continue:
         try:
             next_link = driver.find_element_by_class_name("a-last")
         except NoSuchElementException:
             break
-        time.sleep(1 + random.random())
-        next_link.click()
-        time.sleep(1 + random.random())
+        limiter.acquire()
+        with instrumentation.timer("browser_click"):
+            next_link.click()
+        limiter.acquire()
         curr_url = driver.current_url
         if curr_url == prev_url:
             break
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        to_continue = extract(soup, models, descriptions, dates, ratings, titles, bodies, images, badges, earliest)
+        soup = load_page(driver, limiter, interactive)
+        to_continue = extract(soup, batch, earliest, watermark)
         prev_url = curr_url
 
-    result = pd.DataFrame({"Model No.": models, "Model Description": descriptions, "Date": dates, "Rating": ratings,
-                           "Title": titles, "Body": bodies, "Image": images, "Badge": badges})
-    if model:
-        result["Model No."] = model
-        result["Model Description"] = model2desc[model]
-    return result
+    return build_result(batch, model)
+
+
+def build_result(batch, model=None):
+    constants = {"Model No.": model, "Model Description": model2desc[model]} if model else None
+    return batch.frame(constants, ["Model No.", "Model Description"] + REVIEW_COLUMNS + ["Badge"],
+                       categorical=EXTRA_COLUMNS[:2])
+
+
+def review_page_url(url, page_no):
+    parts = urlparse(url)
+    query = dict(parse_qsl(parts.query), sortBy="recent", pageNumber=str(page_no))
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+@instrumentation.timed_product("amazon", 0)
+def fetch_product(url, model=None, day_lim=None, watermark=None, fallback=None, retries=5, engine=None,
+                  interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    budget = http_session.RetryBudget(retries)
+    earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
+    batch = ReviewBatch(EXTRA_COLUMNS)
+    page_no = 1
+    to_continue = True
+    while to_continue:
+        response = http_session.get(review_page_url(url, page_no), budget, limiter, host_slot(engine, url),
+                                    headers=HEADERS)
+        if is_verification(response.text):
+            limiter.report_blocked()
+            if fallback is None:
+                raise RuntimeError("Verification page at page {}: {}".format(page_no, url))
+            logging.warning("Verification page, falling back to Chrome: {}".format(url))
+            # the product is already timed by fetch_product, the undecorated parse_product does not count it again
+            with fallback.borrow() as driver:
+                return parse_product.__wrapped__(driver, url, model, day_lim, watermark, interactive)
+        soup = parse_page(response.text, "amazon")
+        if not soup.find("div", {"data-hook": "review"}):
+            if page_no == 1:
+                return None
+            break
+        to_continue = extract(soup, batch, earliest, watermark)
+        if 'class="a-disabled a-last"' in response.text:
+            break
+        page_no += 1
+    return build_result(batch, model)
 
 
 if __name__ == "__main__":
@@ -85,8 +162,26 @@ if __name__ == "__main__":
     parser.add_argument("--category", type=str, help="Category of products")
     parser.add_argument("--days", type=int, default=7, help="Limit of days before today (default 7)")
     parser.add_argument("--output", type=str, default="Amazon_Reviews",
-                        help="Name of output .xlsx file (default Amazon_Reviews)")
+                        help="Name of output file (default Amazon_Reviews)")
+    parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                        help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Initial page actions per second on Amazon, adapted to the responses (default 0.6)")
+    parser.add_argument("--drivers", type=int, default=1,
+                        help="Number of Chrome drivers extracting products in parallel (default 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of products fetched in parallel with --engine http (default 1)")
+    parser.add_argument("--host_workers", type=int, default=None,
+                        help="Limit of concurrent requests per host with --engine http (default same as --workers)")
+    parser.add_argument("--headless", action="store_true", help="Run the Chrome drivers headless")
+    parser.add_argument("--engine", type=str, default="selenium",
+                        help="Load review pages with selenium/http, http falls back to Chrome on verification "
+                             "pages (default selenium)")
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
+    STATE, CACHE, INDEX, IMAGES = open_pipeline(args)
+    if args.rate:
+        rate_limiter.configure("amazon.com", rate=args.rate)
     logging.basicConfig(level=logging.INFO)
     with open(args.input + ".json") as f:
         data = json.load(f)
@@ -94,17 +189,45 @@ if __name__ == "__main__":
     if args.category not in urls:
         logging.error("Invalid category: {}".format(args.category))
         quit()
-    DRIVER = webdriver.Chrome("./chromedriver")
-    DRIVER.set_page_load_timeout(10)
-    _ = input("Press ENTER to proceed")
+    if args.engine == "http":
+        POOL = LazyDriver(functools.partial(new_driver, args.headless))
+    else:
+        # the pooled drivers only launch once the products are mapped, so a verification page asks for ENTER when
+        # one of them meets it instead of a prompt before the run
+        POOL = DriverPool(args.drivers, functools.partial(new_driver, args.headless))
     urls_to_do = urls[args.category]
     if type(urls_to_do) == str:
-        product_result = parse_product(DRIVER, urls_to_do, day_lim=args.days)
+        targets = [(urls_to_do, None)]
     else:  # dict
-        product_result = pd.concat(
-            parse_product(DRIVER, target_url, model, args.days) for model, target_url in urls_to_do.items())
-    DRIVER.quit()
-    product_result["Date"] = pd.to_datetime(product_result["Date"], format="%B %d, %Y").map(lambda date_: date_.date())
-    product_result = predict_labels(product_result, TAGs, True)
-    product_result.to_excel("outputs/" + args.output + ".xlsx", header=True, index=False)
-    logging.info("Process completed! Extracted {} reviews".format(len(product_result)))
+        targets = [(target_url, model) for model, target_url in urls_to_do.items()]
+    jobs = [(target_url, model, args.days, STATE.watermark("amazon", target_url) if STATE else None)
+            for target_url, model in targets]
+    # every product is written out as soon as it is complete instead of concatenating all of them at the end
+    SINK = open_sink(args.output, args.format)
+    if args.engine == "http":
+        ENGINE = FetchEngine(args.workers, args.host_workers)
+        outcomes = ENGINE.map(functools.partial(fetch_product, fallback=POOL, engine=ENGINE,
+                                                interactive=not args.headless), jobs)
+    else:
+        outcomes = POOL.map(functools.partial(parse_product, interactive=not args.headless), jobs)
+    for (target_url, *_, watermark), result, error in outcomes:
+        if isinstance(error, TimeoutException):
+            logging.error("Timeout: {}".format(target_url))
+        elif error is not None:
+            logging.error("Failed: {}".format(target_url))
+        elif result is not None:
+            if STATE:
+                STATE.stage("amazon", target_url, watermark)
+            if INDEX:
+                result = INDEX.dedup(result, "amazon", target_url)
+            if len(result) > 0:
+                if IMAGES:
+                    result = IMAGES.localize(result)
+                SINK.write(predict_labels(result, TAGs, True, cache=CACHE))
+    POOL.close()
+    file_name = SINK.close()
+    close_pipeline(INDEX, IMAGES, STATE)
+    if file_name is None:
+        logging.warning("No new reviews")
+        quit()
+    logging.info("Process completed! Extracted {} reviews into {}".format(SINK.rows, file_name))
@@ -0,0 +1,47 @@
+import os
+import time
+import argparse
+from bs4 import BeautifulSoup
+import amazon
+import homedepot
+from html_parsing import parse_page
+from review_records import ReviewBatch
+
+EXTRACTORS = {"amazon": (amazon.extract, amazon.EXTRA_COLUMNS), "homedepot": (homedepot.extract, ())}
+
+
+def run_extract(site, soup):
+    extract, extra = EXTRACTORS[site]
+    batch = ReviewBatch(extra)
+    extract(soup, batch)
+    return [batch.dates.tolist(), batch.ratings.tolist(), batch.titles, batch.bodies, batch.images,
+            *batch.extra.values()]
+
+
+def time_parser(site, pages, parse, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [run_extract(site, parse(page)) for page in pages]
+    return (time.perf_counter() - start) / repeat, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare review page parsing against the html.parser baseline")
+    parser.add_argument("--site", type=str, required=True, help="Site of the saved pages (amazon/homedepot)")
+    parser.add_argument("--pages", type=str, required=True, help="Directory of saved review pages (.html)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of passes over the pages (default 5)")
+    args = parser.parse_args()
+    amazon.size2model = dict()
+    pages = []
+    for file_name in sorted(os.listdir(args.pages)):
+        if file_name.endswith(".html"):
+            with open(os.path.join(args.pages, file_name), encoding="utf-8") as f:
+                pages.append(f.read())
+    baseline_time, baseline = time_parser(args.site, pages, lambda page: BeautifulSoup(page, "html.parser"),
+                                          args.repeat)
+    scoped_time, scoped = time_parser(args.site, pages, lambda page: parse_page(page, args.site), args.repeat)
+    n_reviews = sum(len(columns[0]) for columns in baseline)
+    print("{} pages, {} reviews".format(len(pages), n_reviews))
+    print("html.parser, full document: {:.3f}s per pass".format(baseline_time))
+    print("scoped parse_page:          {:.3f}s per pass ({:.1f}x)".format(scoped_time, baseline_time / scoped_time))
+    print("Identical fields: {}".format(baseline == scoped))
@@ -0,0 +1,126 @@
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import amazon
+import homedepot
+import lowes
+import walmart
+import http_session
+from html_parsing import parse_page
+from replay import start_replay
+from review_classification import predict_labels
+from review_records import ReviewBatch
+
+
+def walmart_reviews(meta, content):
+    if meta["kind"] != "http":
+        return None
+    product_id = json.loads(meta["body"])["itemId"]
+    return json.loads(content)["payload"]["reviews"][product_id]["customerReviews"]
+
+
+# site: (module, parse the fixture into the input of extract, extra columns of the review batch)
+PIPELINES = {
+    "lowes.com": (lowes, lambda meta, content: json.loads(content).get("Results"), ()),
+    "walmart.com": (walmart, walmart_reviews, ()),
+    "homedepot.com": (homedepot, lambda meta, content: parse_page(content.decode("utf-8"), "homedepot"), ()),
+    "amazon.com": (amazon, lambda meta, content: parse_page(content.decode("utf-8"), "amazon"), amazon.EXTRA_COLUMNS)
+}
+
+
+def fetch(store, meta):
+    if meta["kind"] == "page":
+        return store.content(meta)
+    body = meta["body"].encode() if meta["body"] is not None else None
+    return http_session.request(meta["method"], meta["url"], data=body).content
+
+
+def run_pages(store, site, fixtures):
+    module, parse, extra = PIPELINES[site]
+    batch = ReviewBatch(extra)
+    for meta in fixtures:
+        parsed = parse(meta, fetch(store, meta))
+        if parsed:
+            module.extract(parsed, batch)
+    return batch.frame()
+
+
+def benchmark_site(store, site, repeat, labels):
+    # responses that raised or were retried during the recording would not replay as review pages
+    fixtures = [meta for meta in store.entries(site=site) if meta.get("status", 200) == 200]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        reviews = run_pages(store, site, fixtures)
+    elapsed = (time.perf_counter() - start) / repeat
+    result = {"site": site, "pages": len(fixtures), "reviews": len(reviews),
+              "pages_per_sec": len(fixtures) / elapsed, "reviews_per_sec": len(reviews) / elapsed,
+              "labels_per_sec": None}
+    if labels and len(reviews) > 0:
+        start = time.perf_counter()
+        predict_labels(reviews, PIPELINES[site][0].TAGs)
+        result["labels_per_sec"] = len(reviews) / (time.perf_counter() - start)
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(path, commit):
+    """Latest stored result of every site from another commit"""
+    previous = dict()
+    try:
+        with open(path) as f:
+            for line in f:
+                stored = json.loads(line)
+                if stored["commit"] != commit:
+                    previous[stored["site"]] = stored
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def format_rate(value):
+    return "{:10.1f}".format(value) if value is not None else "         -"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scraping pipeline offline over recorded fixtures")
+    parser.add_argument("--fixtures", type=str, default="fixtures",
+                        help="Directory of fixtures recorded with --record (default fixtures)")
+    parser.add_argument("--sites", type=str, nargs="+", default=list(PIPELINES),
+                        help="Sites to benchmark (default all of them)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the fixtures (default 3)")
+    parser.add_argument("--skip_labels", action="store_true", help="Do not measure the labels prediction")
+    parser.add_argument("--results", type=str, default="benchmarks/results.jsonl",
+                        help="File the results are appended to for comparison across commits "
+                             "(default benchmarks/results.jsonl)")
+    args = parser.parse_args()
+    STORE = start_replay(args.fixtures)
+    amazon.size2model = dict()
+    COMMIT = current_commit()
+    PREVIOUS = previous_results(args.results, COMMIT)
+    print("{:15}{:>8}{:>9}{:>11}{:>11}{:>11}".format("site", "pages", "reviews", "pages/s", "reviews/s", "labels/s"))
+    with open(args.results, "a") as f:
+        for site in args.sites:
+            result = benchmark_site(STORE, site, args.repeat, not args.skip_labels)
+            if result["pages"] == 0:
+                continue
+            print("{:15}{:8}{:9}{}{}{}".format(site, result["pages"], result["reviews"],
+                                               format_rate(result["pages_per_sec"]),
+                                               format_rate(result["reviews_per_sec"]),
+                                               format_rate(result["labels_per_sec"])))
+            if site in PREVIOUS:
+                stored = PREVIOUS[site]
+                print("{:15}{:8}{:9}{}{}{}".format("  @" + str(stored["commit"]), stored["pages"], stored["reviews"],
+                                                   format_rate(stored["pages_per_sec"]),
+                                                   format_rate(stored["reviews_per_sec"]),
+                                                   format_rate(stored["labels_per_sec"])))
+            f.write(json.dumps(dict(result, commit=COMMIT,
+                                    date=datetime.datetime.now().isoformat(timespec="seconds"))) + "\n")
@@ -0,0 +1,43 @@
+import re
+import time
+import argparse
+import pandas as pd
+from nltk.tokenize import word_tokenize
+from nltk.stem.porter import PorterStemmer
+from review_classification import get_stopwords, process_texts
+
+
+def reference_process_text(review, stemmer=PorterStemmer(), stopwords=list(get_stopwords())):
+    # the former implementation: list lookups, uncached stems and NLTK tokenization
+    title, text = review["Title"], review["Body"]
+    title = "" if type(title) != str else title
+    text = "" if type(text) != str else text
+    if not (title.endswith("...") and title[:-3] in text):
+        text = " ".join((title, text))
+    text = re.sub("[^A-Za-z]", " ", text.lower())
+    return " ".join(stemmer.stem(word) for word in word_tokenize(text) if word not in stopwords)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark review text preprocessing")
+    parser.add_argument("--data", type=str, default="review_classification/training_data.csv",
+                        help="CSV file with Title and Body columns (default review_classification/training_data.csv)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of processes for the pool run (default 4)")
+    parser.add_argument("--chunk_size", type=int, default=2000, help="Rows per chunk for the pool run (default 2000)")
+    args = parser.parse_args()
+    data = pd.read_csv(args.data)
+    start = time.perf_counter()
+    reference = data.apply(reference_process_text, axis=1)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    single = process_texts(data)
+    single_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pooled = process_texts(data, args.workers, args.chunk_size)
+    pooled_time = time.perf_counter() - start
+    print("{} reviews".format(len(data)))
+    print("reference:            {:.3f}s".format(reference_time))
+    print("process_texts:        {:.3f}s ({:.1f}x)".format(single_time, reference_time / single_time))
+    print("process_texts, {} processes: {:.3f}s ({:.1f}x)".format(args.workers, pooled_time,
+                                                                 reference_time / pooled_time))
+    print("Identical output: {}".format(reference.equals(single) and reference.equals(pooled)))
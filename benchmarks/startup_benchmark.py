@@ -0,0 +1,30 @@
+import sys
+import time
+import argparse
+import subprocess
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import review_classification; " \
+                "print(time.perf_counter() - start)"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure classification startup and first prediction latency")
+    parser.add_argument("--tags", type=str, nargs="+", default=["sound", "no cooling", "condensate drain issues"],
+                        help="Tags to predict (default sound, no cooling, condensate drain issues)")
+    args = parser.parse_args()
+    # the import is timed in a fresh interpreter so that nothing is cached yet
+    import_time = float(subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True,
+                                       check=True).stdout)
+    import pandas as pd
+    from review_classification import predict_labels
+    sample = pd.DataFrame({"Title": ["Too loud", "Great"], "Body": ["It does not cool the room", "Works fine"],
+                           "Rating": [1, 5]})
+    start = time.perf_counter()
+    predict_labels(sample.copy(), args.tags)
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    predict_labels(sample.copy(), args.tags)
+    second_time = time.perf_counter() - start
+    print("import review_classification: {:.3f}s".format(import_time))
+    print("first prediction (loads the model bundle): {:.3f}s".format(first_time))
+    print("next prediction: {:.3f}s".format(second_time))
@@ -0,0 +1,36 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+
+def fingerprint(items):
+    return hashlib.sha1(json.dumps(sorted(items)).encode()).hexdigest()
+
+
+class CatalogCache:
+    def __init__(self, path="catalog.sqlite", ttl=24 * 3600):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS catalogs (retailer TEXT, category TEXT, targets TEXT, "
+                                "first_page TEXT, updated REAL, PRIMARY KEY (retailer, category))")
+        self.connection.commit()
+
+    def get(self, retailer, category, first_page=None):
+        """Targets discovered for the category within the TTL, None if stale or if the given first page changed"""
+        row = self.connection.execute("SELECT targets, first_page, updated FROM catalogs "
+                                      "WHERE retailer = ? AND category = ?", (retailer, category)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        if first_page is not None and fingerprint(first_page) != row[1]:
+            return None
+        return [tuple(target) if isinstance(target, list) else target for target in json.loads(row[0])]
+
+    def put(self, retailer, category, targets, first_page=None):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO catalogs VALUES (?, ?, ?, ?, ?)",
+                                    (retailer, category, json.dumps(sorted(targets)),
+                                     None if first_page is None else fingerprint(first_page), time.time()))
+
+    def close(self):
+        self.connection.close()
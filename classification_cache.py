@@ -0,0 +1,70 @@
+import json
+import sqlite3
+import hashlib
+
+
+def rating_text(rating):
+    # a rating is int8 in most products but float where another rating of the product is missing, both give one key
+    return "" if rating is None or rating != rating else str(int(rating))
+
+
+def content_key(title, body, rating, version):
+    fields = ("" if type(title) != str else title, "" if type(body) != str else body, rating_text(rating), version)
+    return hashlib.sha256("\x1f".join(fields).encode()).hexdigest()
+
+
+class ClassificationCache:
+    def __init__(self, path="review_classification/label_cache.sqlite"):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, labels TEXT)")
+        self.connection.commit()
+
+    def get_many(self, keys, batch_size=500):
+        found = dict()
+        keys = list(set(keys))
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            rows = self.connection.execute("SELECT key, labels FROM labels WHERE key IN ({})".format(
+                ", ".join("?" * len(batch))), batch).fetchall()
+            found.update((key, json.loads(labels)) for key, labels in rows)
+        return found
+
+    def put_many(self, items):
+        # labels of tags predicted earlier under the same key are kept next to the new ones
+        items = dict(items)
+        existing = self.get_many(items.keys())
+        self.connection.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?)", [
+            (key, json.dumps(dict(existing.get(key, dict()), **labels))) for key, labels in items.items()])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def text_key(title, body, version):
+    fields = ("" if type(title) != str else title, "" if type(body) != str else body, version)
+    return hashlib.sha256("\x1f".join(fields).encode()).hexdigest()
+
+
+class TextCache:
+    """Preprocessed texts of reviews, keyed by their title, body and the version of the preprocessing"""
+    def __init__(self, path="review_classification/text_cache.sqlite"):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, text TEXT)")
+        self.connection.commit()
+
+    def get_many(self, keys, batch_size=500):
+        found = dict()
+        keys = list(set(keys))
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            found.update(self.connection.execute("SELECT key, text FROM texts WHERE key IN ({})".format(
+                ", ".join("?" * len(batch))), batch).fetchall())
+        return found
+
+    def put_many(self, items):
+        self.connection.executemany("INSERT OR REPLACE INTO texts VALUES (?, ?)", items)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,56 @@
+import json
+import pickle
+import sqlite3
+import datetime
+
+
+class CrawlJournal:
+    def __init__(self, retailer, category, path="journal.sqlite", resume=False):
+        self.retailer = retailer
+        self.category = category
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS targets (retailer TEXT, category TEXT, position INTEGER, "
+                                "target TEXT, PRIMARY KEY (retailer, category, position))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS products (retailer TEXT, category TEXT, product TEXT, "
+                                "result BLOB, updated TEXT, PRIMARY KEY (retailer, category, product))")
+        self.connection.commit()
+        if not resume:
+            self.clear()
+
+    def targets(self):
+        """Targets discovered by the interrupted crawl, None if discovery did not finish"""
+        rows = self.connection.execute("SELECT target FROM targets WHERE retailer = ? AND category = ? "
+                                       "ORDER BY position", (self.retailer, self.category)).fetchall()
+        if not rows:
+            return None
+        targets = [json.loads(row[0]) for row in rows]
+        return [tuple(target) if isinstance(target, list) else target for target in targets]
+
+    def save_targets(self, targets):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?)",
+                                        [(self.retailer, self.category, position, json.dumps(target))
+                                         for position, target in enumerate(targets)])
+
+    def completed(self):
+        """Map every product finished by the interrupted crawl to its (result, watermark)"""
+        rows = self.connection.execute("SELECT product, result FROM products WHERE retailer = ? AND category = ?",
+                                       (self.retailer, self.category)).fetchall()
+        return {product: pickle.loads(result) for product, result in rows}
+
+    def complete(self, product, result, watermark=None):
+        # committed per product, so an interrupted crawl loses at most the products in flight
+        updated = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)",
+                                    (self.retailer, self.category, product,
+                                     pickle.dumps((result, watermark), pickle.HIGHEST_PROTOCOL), updated))
+
+    def clear(self):
+        with self.connection:
+            for table in ("targets", "products"):
+                self.connection.execute("DELETE FROM {} WHERE retailer = ? AND category = ?".format(table),
+                                        (self.retailer, self.category))
+
+    def close(self):
+        self.connection.close()
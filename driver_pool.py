@@ -0,0 +1,176 @@
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+_WRAPPER = None
+
+
+def new_driver(headless=False, page_load_timeout=10):
+    options = webdriver.ChromeOptions()
+    if headless:
+        options.add_argument("--headless")
+    driver = webdriver.Chrome("./chromedriver", options=options)
+    driver.set_page_load_timeout(page_load_timeout)
+    return _WRAPPER(driver) if _WRAPPER is not None else driver
+
+
+def wrap_drivers(wrapper=None):
+    """Pass every driver launched by new_driver through wrapper, e.g. to record the page sources"""
+    global _WRAPPER
+    _WRAPPER = wrapper
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+
+
+def is_alive(driver):
+    try:
+        _ = driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+class DriverPool:
+    def __init__(self, size=1, factory=new_driver, spares=1):
+        self.size = max(1, size)
+        self.factory = factory
+        self.spares = queue.Queue()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._launching = []
+        for _ in range(spares):
+            self._launch(self._warm_up)
+
+    def _launch(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        with self._lock:
+            self._launching = [launching for launching in self._launching if launching.is_alive()] + [thread]
+            thread.start()
+
+    def _warm_up(self):
+        try:
+            spare = self.factory()
+        except WebDriverException as error:
+            logging.error("Failed to launch spare driver: {}".format(error))
+            spare = None
+        with self._lock:
+            if not self.closed:
+                self.spares.put(spare)
+                return
+        # a spare finished launching after the pool was closed quits instead of being left running
+        if spare is not None:
+            quit_driver(spare)
+
+    def _recycle(self, driver):
+        # the broken driver is torn down and a spare is launched off the worker thread
+        quit_driver(driver)
+        self._warm_up()
+
+    def _replace(self, driver):
+        self._launch(self._recycle, driver)
+        spare = self.spares.get()
+        return spare if spare is not None else self.factory()
+
+    def _work(self, func, jobs, active):
+        driver = None
+        try:
+            driver = self.factory()
+            while True:
+                try:
+                    job, future = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    future.set_result(func(driver, *job))
+                except TimeoutException as error:
+                    future.set_exception(error)
+                    driver = self._replace(driver)
+                except Exception as error:
+                    future.set_exception(error)
+                    if not is_alive(driver):
+                        driver = self._replace(driver)
+        except WebDriverException as error:
+            logging.error("Driver worker stopped: {}".format(error))
+        finally:
+            if driver is not None:
+                quit_driver(driver)
+            with active["lock"]:
+                active["count"] -= 1
+                last = active["count"] == 0
+            # jobs left behind by workers that could not launch a driver are failed instead of waiting forever
+            while last:
+                try:
+                    _, future = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                future.set_exception(WebDriverException("No driver available"))
+
+    def map(self, func, jobs):
+        """Run func(driver, *job) for every job on the pooled drivers, yield (job, result, error) in the order of jobs"""
+        futures = [(job, Future()) for job in jobs]
+        pending = queue.Queue()
+        for item in futures:
+            pending.put(item)
+        count = min(self.size, len(futures))
+        active = {"count": count, "lock": threading.Lock()}
+        workers = [threading.Thread(target=self._work, args=(func, pending, active), daemon=True)
+                   for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        for job, future in futures:
+            try:
+                yield job, future.result(), None
+            except Exception as error:
+                yield job, None, error
+        for worker in workers:
+            worker.join()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            launching = list(self._launching)
+        # the spares still launching are waited for, daemon threads would otherwise be killed at exit mid-launch
+        for thread in launching:
+            thread.join()
+        while True:
+            try:
+                spare = self.spares.get_nowait()
+            except queue.Empty:
+                break
+            if spare is not None:
+                quit_driver(spare)
+
+
+class LazyDriver:
+    def __init__(self, factory=new_driver):
+        self.factory = factory
+        self.driver = None
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.driver is None:
+                self.driver = self.factory()
+            return self.driver
+
+    @contextmanager
+    def borrow(self):
+        """The driver, held by one caller at a time, e.g. by the fallback of one of several fetch workers"""
+        with self.busy:
+            yield self()
+
+    def close(self):
+        with self.lock:
+            if self.driver is not None:
+                quit_driver(self.driver)
+                self.driver = None
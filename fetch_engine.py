@@ -0,0 +1,71 @@
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlparse
+
+
+class FetchEngine:
+    def __init__(self, workers=1, per_host=None):
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host) if per_host else self.workers
+        self._slots = dict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def slot(self, url):
+        # caps the number of requests in flight for one host, shared by all workers
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._slots[host]
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown(wait=True, cancel_futures=exc_info[0] is not None)
+        self._executor = None
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    def map(self, func, jobs):
+        """Run func(*job) for every job concurrently, yield (job, result, error) in the order of jobs"""
+        with self:
+            futures = [(job, self.submit(func, *job)) for job in jobs]
+            for job, future in futures:
+                try:
+                    yield job, future.result(), None
+                except Exception as error:
+                    yield job, None, error
+
+
+def host_slot(engine, url):
+    return engine.slot(url) if engine else nullcontext()
+
+
+def prefetch(fetch, pages, depth=1):
+    """Yield fetch(page) for every page in order while up to depth pages are in flight
+
+    Closing the generator, e.g. when the caller reached its date cutoff, cancels the pages not started yet and drops
+    the results of those in flight."""
+    pages = iter(pages)
+    if depth <= 1:
+        for page in pages:
+            yield fetch(page)
+        return
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        in_flight = deque(executor.submit(fetch, page) for page in itertools.islice(pages, depth))
+        try:
+            while in_flight:
+                result = in_flight.popleft().result()
+                for page in itertools.islice(pages, 1):
+                    in_flight.append(executor.submit(fetch, page))
+                yield result
+        finally:
+            for future in in_flight:
+                future.cancel()
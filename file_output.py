@@ -1,4 +1,5 @@
 import pandas as pd
+import instrumentation
 
 
 def df2excel(df: pd.DataFrame, output: str) -> str:
@@ -6,8 +7,138 @@ def df2excel(df: pd.DataFrame, output: str) -> str:
     while True:
         file_name = "outputs/" + output + str(version) + ".xlsx" if version else "outputs/" + output + ".xlsx"
         try:
-            df.to_excel("outputs/" + output + ".xlsx", header=True, index=False)
+            df.to_excel(file_name, header=True, index=False)
             break
         except PermissionError:
             version += 1
     return file_name
+
+
+def open_versioned(output: str, extension: str, mode: str = "wb"):
+    # same naming as df2excel: a file locked by another program gets a numbered sibling instead
+    version = 0
+    while True:
+        file_name = "outputs/" + output + (str(version) if version else "") + "." + extension
+        try:
+            return file_name, open(file_name, mode)
+        except PermissionError:
+            version += 1
+
+
+class ReviewSink:
+    extension = None
+
+    def __init__(self, output: str):
+        self.output = output
+        self.file_name = None
+        self.rows = 0
+
+    @instrumentation.timed("output_write")
+    def write(self, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+        if self.file_name is None:
+            self.open(df)
+        self.append(df)
+        self.rows += len(df)
+
+    def open(self, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def append(self, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def close(self) -> str:
+        """Finish the file, return its name or None if nothing was written"""
+        return self.file_name
+
+
+class ExcelSink(ReviewSink):
+    extension = "xlsx"
+
+    def open(self, df):
+        from openpyxl import Workbook
+        self.file_name, self.file = open_versioned(self.output, self.extension)
+        # a write-only workbook streams rows to a temporary file instead of keeping cells in memory
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(df.columns.to_list())
+
+    def append(self, df):
+        # datetime64 columns are written as dates, without a time of day
+        df = df.assign(**{column: df[column].dt.date for column in df.select_dtypes("datetime").columns})
+        for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            self.sheet.append(row)
+
+    @instrumentation.timed("output_write")
+    def close(self):
+        if self.file_name is not None:
+            self.workbook.save(self.file)
+            self.file.close()
+        return self.file_name
+
+
+class CsvSink(ReviewSink):
+    extension = "csv"
+
+    def open(self, df):
+        self.file_name, self.file = open_versioned(self.output, self.extension, "w")
+        self.header = True
+
+    def append(self, df):
+        df.to_csv(self.file, header=self.header, index=False, lineterminator="\n")
+        self.header = False
+        self.file.flush()
+
+    @instrumentation.timed("output_write")
+    def close(self):
+        if self.file_name is not None:
+            self.file.close()
+        return self.file_name
+
+
+def parquet_field(field, empty=False):
+    import pyarrow as pa
+    if pa.types.is_dictionary(field.type):
+        # categoricals empty in the first batch have no value type yet, and later ones may have more categories than
+        # the index type of the first fits
+        value_type = pa.string() if empty or pa.types.is_null(field.type.value_type) else field.type.value_type
+        return pa.field(field.name, pa.dictionary(pa.int32(), value_type))
+    if pa.types.is_null(field.type):
+        return pa.field(field.name, pa.string())
+    if pa.types.is_timestamp(field.type):
+        return pa.field(field.name, pa.date32())
+    return field
+
+
+class ParquetSink(ReviewSink):
+    extension = "parquet"
+
+    def open(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.file_name, self.file = open_versioned(self.output, self.extension)
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        # columns that are empty in the first batch are stored as strings and datetime64 columns as dates
+        self.schema = pa.schema([parquet_field(field, df[field.name].isna().all()) for field in schema])
+        self.integers = [field.name for field in self.schema if pa.types.is_integer(field.type)]
+        self.writer = pq.ParquetWriter(self.file, self.schema)
+
+    def append(self, df):
+        import pyarrow as pa
+        df = df.astype({column: "Int64" for column in self.integers})
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    @instrumentation.timed("output_write")
+    def close(self):
+        if self.file_name is not None:
+            self.writer.close()
+            self.file.close()
+        return self.file_name
+
+
+SINKS = {"xlsx": ExcelSink, "csv": CsvSink, "parquet": ParquetSink}
+
+
+def open_sink(output: str, file_format: str = "xlsx") -> ReviewSink:
+    return SINKS[file_format](output)
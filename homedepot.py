@@ -1,61 +1,91 @@
-from selenium import webdriver
 from selenium.webdriver.support.ui import Select
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from bs4 import BeautifulSoup
 import tqdm
-import pandas as pd
 import re
-import time
 import datetime
-import random
 import argparse
+import functools
 import logging
 from review_classification import predict_labels
-from file_output import df2excel
+from file_output import open_sink, SINKS
+import rate_limiter
+from state_store import review_key
+from review_records import ReviewBatch
+from crawl_journal import CrawlJournal
+from catalog_cache import CatalogCache
+from html_parsing import parse_page
+from driver_pool import DriverPool, LazyDriver, new_driver
+from fetch_engine import FetchEngine, host_slot
+import http_session
+import instrumentation
+from pipeline import add_pipeline_arguments, open_pipeline, close_pipeline
 
 URLs = {
     "Window": "https://www.homedepot.com/b/Heating-Venting-Cooling-Air-Conditioners-Window-Air-Conditioners/N-5yc1vZc4lu",
     "Portable": "https://www.homedepot.com/b/Heating-Venting-Cooling-Air-Conditioners-Portable-Air-Conditioners/N-5yc1vZc4m4",
     "Dehumidifier": "https://www.homedepot.com/b/Heating-Venting-Cooling-Dehumidifiers/N-5yc1vZc4l8"
 }
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+REVIEW_PAGE_URL = "{}/{}?sort=newest"
 TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
 
 
-def extract(soup, dates, ratings, titles, bodies, images, earliest=None):
+@instrumentation.timed("extract")
+def extract(soup, batch, earliest=None, watermark=None):
     reviews = soup.find_all("div", {"class": "review_item"})
     for review in reviews:
         date = review.find("span", {"class": "review-content__date"}).text.strip()
-        if earliest and datetime.datetime.strptime(date, "%b %d, %Y").date() < earliest:
+        review_date = datetime.datetime.strptime(date, "%b %d, %Y").date()
+        if earliest and review_date < earliest:
             return False
-        dates.append(date)
-        rating_raw = review.find("span", {"class": "stars"}).attrs["style"]
-        ratings.append(int(re.findall("\\d+", rating_raw)[0]) // 20)
         title = review.find("span", {"class": "review-content__title"})
-        titles.append(title.text.strip() if title else None)
+        title = title.text.strip() if title else None
         body = review.find("div", {"class": "review-content-body"})
-        bodies.append(body.text.strip() if body else None)
+        body = body.text.strip() if body else None
+        if watermark is not None:
+            key = review_key(date, title, body)
+            if watermark.reached(review_date, key):
+                return False
+            watermark.observe(review_date, key)
+        rating_raw = review.find("span", {"class": "stars"}).attrs["style"]
         images_raw = review.find_all("div", {"class": "media-carousel__media"})
-        images.append("\n".join(
+        batch.add(review_date, int(re.findall("\\d+", rating_raw)[0]) // 20, title, body, "\n".join(
             re.findall('url\\("?(\\S+?)"?\\)', image.find("button").attrs["style"])[0] for image in images_raw))
     return True
 
 
-def parse_product(driver, url, day_lim=None, err_terminate=False):
-    driver.get(url)
-    time.sleep(2 + random.random())
+def load_page(driver, limiter, interactive=True):
+    soup = parse_page(driver.page_source, "homedepot")
+    if is_verification(soup):
+        limiter.report_blocked()
+        # nobody can complete the verification in a headless browser, so the product fails instead of waiting
+        if not interactive:
+            raise RuntimeError("Verification page in Chrome: {}".format(driver.current_url))
+        _ = input("Complete verification and press ENTER to proceed")
+        soup = parse_page(driver.page_source, "homedepot")
+    return soup
+
+
+@instrumentation.timed_product("homedepot", 1)
+def parse_product(driver, url, day_lim=None, err_terminate=False, watermark=None, interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    limiter.acquire()
+    with instrumentation.timer("browser_load"):
+        driver.get(url)
+    limiter.acquire()
+    load_page(driver, limiter, interactive)
     drop_down = Select(driver.find_element_by_class_name("drop-down__select"))
     drop_down.select_by_value("newest")
-    time.sleep(1 + random.random())
+    limiter.acquire()
     drop_down.select_by_value("newest")
-    time.sleep(1 + random.random())
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    title = soup.find("h1", {"class": "page-title"}).text.replace("\n", " ").replace("<!-- -->", "")
-    model_description = re.findall("Customer\\s+Reviews\\s+for\\s+(.+)", title)[0]
-    model = soup.find_all("h2", {"class": "product-info-bar__detail--24WIp"})[1].text.replace("<!-- -->", "")
-    model_no = re.findall("Model\\s+#(.+)$", model)[0]
+    limiter.acquire()
+    soup = parse_page(driver.page_source, "homedepot")
+    model_no, model_description = parse_header(soup)
     earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
-    dates, ratings, titles, bodies, images = [], [], [], [], []
-    to_continue = extract(soup, dates, ratings, titles, bodies, images, earliest)
+    batch = ReviewBatch()
+    to_continue = extract(soup, batch, earliest, watermark)
     prev_page = "1"
 
     while to_continue:
@@ -63,10 +93,11 @@ def parse_product(driver, url, day_lim=None, err_terminate=False):
         if not links:
             break
         next_link = links[-1]
-        time.sleep(1 + random.random())
-        next_link.click()
-        time.sleep(1 + random.random())
-        soup = BeautifulSoup(driver.page_source, "html.parser")
+        limiter.acquire()
+        with instrumentation.timer("browser_click"):
+            next_link.click()
+        limiter.acquire()
+        soup = parse_page(driver.page_source, "homedepot")
         try:
             curr_page = soup.find("span", {"class": "pager-summary__bold"}).text
         except AttributeError:
@@ -76,49 +107,122 @@ def parse_product(driver, url, day_lim=None, err_terminate=False):
             else:
                 raise AttributeError
         if curr_page == prev_page:
-            time.sleep(5 + random.random())
+            limiter.report(None)
             continue
         elif curr_page == "1":
             break
-        to_continue = extract(soup, dates, ratings, titles, bodies, images, earliest)
+        limiter.report()
+        to_continue = extract(soup, batch, earliest, watermark)
         prev_page = curr_page
 
-    result = pd.DataFrame({"Date": dates, "Rating": ratings, "Title": titles, "Body": bodies, "Image": images})
-    result["Model No."] = model_no
-    result["Model Description"] = model_description
-    result["Manufacturer"] = model_description.split()[0]
-    return result[["Manufacturer", "Model No.", "Model Description", "Date", "Rating", "Title", "Body", "Image"]]
+    return build_result(batch, model_no, model_description)
 
 
-def parse_content(driver, url):
-    driver.get(url)
-    time.sleep(7 + random.random())
-    target_items = set()
+def parse_header(soup):
+    title = soup.find("h1", {"class": "page-title"}).text.replace("\n", " ").replace("<!-- -->", "")
+    model_description = re.findall("Customer\\s+Reviews\\s+for\\s+(.+)", title)[0]
+    model = soup.find_all("h2", {"class": "product-info-bar__detail--24WIp"})[1].text.replace("<!-- -->", "")
+    model_no = re.findall("Model\\s+#(.+)$", model)[0]
+    return model_no, model_description
+
+
+def build_result(batch, model_no, model_description):
+    return batch.frame({"Manufacturer": model_description.split()[0], "Model No.": model_no,
+                        "Model Description": model_description})
+
+
+def is_verification(soup):
+    return soup.find("h1", {"class": "page-title"}) is None
+
+
+@instrumentation.timed_product("homedepot", 0)
+def fetch_product(url, day_lim=None, err_terminate=False, watermark=None, fallback=None, retries=5, engine=None,
+                  interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    budget = http_session.RetryBudget(retries)
+    earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
+    batch = ReviewBatch()
+    model_no, model_description = None, None
+    page_no = 1
+    to_continue = True
+    while to_continue:
+        response = http_session.get(REVIEW_PAGE_URL.format(url, page_no), budget, limiter, host_slot(engine, url),
+                                    headers=HEADERS)
+        soup = parse_page(response.text, "homedepot")
+        if is_verification(soup):
+            limiter.report_blocked()
+            if fallback is None:
+                raise RuntimeError("Verification page at page {}: {}".format(page_no, url))
+            logging.warning("Verification page, falling back to Chrome: {}".format(url))
+            # the product is already timed by fetch_product, the undecorated parse_product does not count it again
+            with fallback.borrow() as driver:
+                return parse_product.__wrapped__(driver, url, day_lim, err_terminate, watermark, interactive)
+        if page_no == 1:
+            model_no, model_description = parse_header(soup)
+        pager = soup.find("span", {"class": "pager-summary__bold"})
+        # pages past the last one are served as the first page again
+        if page_no > 1 and (pager is None or pager.text != str(page_no)):
+            break
+        to_continue = extract(soup, batch, earliest, watermark)
+        if not soup.find("div", {"class": "review_item"}):
+            break
+        page_no += 1
+    return build_result(batch, model_no, model_description)
+
+
+def finish_result(result, predict=False, cache=None, index=None, product=None, images=None):
+    if index is not None:
+        result = index.dedup(result, "homedepot", product)
+    if images is not None and len(result) > 0:
+        result = images.localize(result)
+    return predict_labels(result, TAGs, True, cache=cache) if predict and len(result) > 0 else result
+
+
+def open_browser():
+    driver = new_driver()
+    _ = input("Press ENTER to proceed")
+    return driver
+
+
+def page_items(driver):
+    items = set()
     for item in driver.find_elements_by_class_name("browse-search__pod"):
         try:
             item.find_element_by_class_name("product-pod__ratings-count")
-            target_items.add(re.findall('<a href="(\\S+)"\\s+class="header', item.get_attribute("innerHTML"))[0])
+            items.add(re.findall('<a href="(\\S+)"\\s+class="header', item.get_attribute("innerHTML"))[0])
         except NoSuchElementException:
             pass
+    return items
+
+
+def first_page(driver, url):
+    limiter = rate_limiter.get_limiter(url)
+    limiter.acquire()
+    with instrumentation.timer("browser_load"):
+        driver.get(url)
+    limiter.acquire()
+    return page_items(driver)
+
+
+def parse_content(driver, url):
+    limiter = rate_limiter.get_limiter(url)
+    target_items = first_page(driver, url)
     prev_page = "1"
     while True:
         next_link = driver.find_elements_by_class_name("hd-pagination__link")[-1]
-        time.sleep(1 + random.random())
-        next_link.click()
-        time.sleep(2 + random.random())
-        soup = BeautifulSoup(driver.page_source, "html.parser")
+        limiter.acquire()
+        with instrumentation.timer("browser_click"):
+            next_link.click()
+        limiter.acquire()
+        soup = parse_page(driver.page_source)
         curr_page = soup.find("span", {"class": "results-pagination__counts--number"}).text.strip().split("-")[0]
         if curr_page == prev_page:
-            time.sleep(3 + random.random())
+            limiter.report(None)
             continue
         elif curr_page == "1":
             break
-        for item in driver.find_elements_by_class_name("browse-search__pod"):
-            try:
-                item.find_element_by_class_name("product-pod__ratings-count")
-                target_items.add(re.findall('<a href="(\\S+)"\\s+class="header', item.get_attribute("innerHTML"))[0])
-            except NoSuchElementException:
-                pass
+        limiter.report()
+        target_items |= page_items(driver)
         prev_page = curr_page
     return target_items
 
@@ -131,49 +235,120 @@ if __name__ == "__main__":
     parser.add_argument("--days", type=int, default=7, help="Limit of days before today (default 7)")
     parser.add_argument("--predict_labels", action="store_true", help="Indicate labels prediction")
     parser.add_argument("--output", type=str, default="Homedepot_Reviews",
-                        help="Name of output .xlsx file (default Homedepot_Reviews)")
+                        help="Name of output file (default Homedepot_Reviews)")
+    parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                        help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Initial page actions per second on Homedepot, adapted to the responses (default 0.6)")
+    parser.add_argument("--drivers", type=int, default=1,
+                        help="Number of Chrome drivers extracting products in parallel (default 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of products fetched in parallel with --engine http (default 1)")
+    parser.add_argument("--host_workers", type=int, default=None,
+                        help="Limit of concurrent requests per host with --engine http (default same as --workers)")
+    parser.add_argument("--headless", action="store_true", help="Run the pooled Chrome drivers headless")
+    parser.add_argument("--engine", type=str, default="selenium",
+                        help="Load review pages with selenium/http, http falls back to Chrome on verification "
+                             "pages (default selenium)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the interrupted crawl of the category without refetching finished products")
+    parser.add_argument("--journal", type=str, default="journal.sqlite",
+                        help="Path of the checkpoint journal of category crawls (default journal.sqlite)")
+    parser.add_argument("--catalog", type=str, default="catalog.sqlite",
+                        help="Path of the cache of products found in each category (default catalog.sqlite)")
+    parser.add_argument("--catalog_ttl", type=float, default=24,
+                        help="Hours the products found in a category are reused, 0 to always search (default 24)")
+    parser.add_argument("--check_first_page", action="store_true",
+                        help="Search the category again if its first listing page changed since it was cached")
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
-    DRIVER = webdriver.Chrome("./chromedriver")
-    DRIVER.set_page_load_timeout(10)
-    _ = input("Press ENTER to proceed")
+    STATE, CACHE, INDEX, IMAGES = open_pipeline(args, args.predict_labels)
+    if args.rate:
+        rate_limiter.configure("homedepot.com", rate=args.rate)
+    # every product is written out as soon as it is complete instead of concatenating all of them at the end
+    SINK = open_sink(args.output, args.format)
+    # the browser is only launched once a page has to be loaded, cached or journaled categories skip the search
+    DRIVER = LazyDriver(open_browser)
     if args.mode == "category" and args.category in URLs:
         logging.basicConfig(level=logging.INFO, filename="logging.log", filemode="w")
         URL = URLs[args.category]
-        targets = parse_content(DRIVER, URL)
+        JOURNAL = CrawlJournal("homedepot", args.category, args.journal, args.resume)
+        targets = JOURNAL.targets()
+        if targets is None:
+            CATALOG = CatalogCache(args.catalog, args.catalog_ttl * 3600)
+            FIRST_PAGE = first_page(DRIVER(), URL) if args.check_first_page else None
+            targets = CATALOG.get("homedepot", args.category, FIRST_PAGE)
+            if targets is None:
+                targets = parse_content(DRIVER(), URL)
+                CATALOG.put("homedepot", args.category, targets, FIRST_PAGE)
+            CATALOG.close()
+            JOURNAL.save_targets(targets)
         logging.info("Found {} products".format(len(targets)))
-        results = []
-        for target in tqdm.tqdm(targets):
+        DRIVER.close()
+        done = JOURNAL.completed()
+        for target_url, (result, watermark) in done.items():
+            if STATE:
+                STATE.stage("homedepot", target_url, watermark)
+            if result is not None and len(result) > 0:
+                SINK.write(finish_result(result, args.predict_labels, CACHE, INDEX, target_url, IMAGES))
+        if done:
+            logging.info("Resumed {} finished products".format(len(done)))
+        if args.engine == "http":
+            POOL = LazyDriver(functools.partial(new_driver, args.headless))
+            ENGINE = FetchEngine(args.workers, args.host_workers)
+        else:
+            POOL = DriverPool(args.drivers, functools.partial(new_driver, args.headless))
+        jobs = []
+        for target in targets:
             target_url = "https://www.homedepot.com/p/reviews" + target[2:]
-            try:
-                results.append(parse_product(DRIVER, target_url, args.days))
-                if results[-1] is not None and len(results[-1]) > 0:
-                    logging.info("Success: {}, extracted {} reviews".format(results[-1].iloc[0, 2], len(results[-1])))
-                else:
-                    logging.warning("No new reviews: {}".format(target_url))
-            except TimeoutException:
+            if target_url in done:
+                continue
+            jobs.append((target_url, args.days, False, STATE.watermark("homedepot", target_url) if STATE else None))
+        if args.engine == "http":
+            outcomes = ENGINE.map(functools.partial(fetch_product, fallback=POOL, engine=ENGINE,
+                                                    interactive=not args.headless), jobs)
+        else:
+            outcomes = POOL.map(functools.partial(parse_product, interactive=not args.headless), jobs)
+        for (target_url, *_, watermark), result, error in tqdm.tqdm(outcomes, total=len(jobs)):
+            if isinstance(error, TimeoutException):
                 logging.error("Timeout: {}".format(target_url))
-                DRIVER.quit()
-                DRIVER = webdriver.Chrome("./chromedriver")
-                DRIVER.set_page_load_timeout(10)
-            except Exception:
+            elif error is not None:
                 logging.error("Failed: {}".format(target_url))
-        DRIVER.quit()
-        final = pd.concat(results)
+            else:
+                JOURNAL.complete(target_url, result, watermark)
+                if STATE:
+                    STATE.stage("homedepot", target_url, watermark)
+                if result is not None and len(result) > 0:
+                    logging.info("Success: {}, extracted {} reviews".format(result.iloc[0, 2], len(result)))
+                    SINK.write(finish_result(result, args.predict_labels, CACHE, INDEX, target_url, IMAGES))
+                else:
+                    logging.warning("No new reviews: {}".format(target_url))
+        POOL.close()
     elif args.mode == "product":
         logging.basicConfig(level=logging.INFO)
-        final = parse_product(DRIVER, args.product, args.days, err_terminate=True)
-        DRIVER.quit()
+        WATERMARK = STATE.watermark("homedepot", args.product) if STATE else None
+        if args.engine == "http":
+            final = fetch_product(args.product, args.days, True, WATERMARK, fallback=DRIVER)
+        else:
+            final = parse_product(DRIVER(), args.product, args.days, err_terminate=True, watermark=WATERMARK)
+        DRIVER.close()
+        if STATE:
+            STATE.stage("homedepot", args.product, WATERMARK)
         if final is None or len(final) == 0:
             logging.warning("No new reviews: {}".format(args.product))
             quit()
         logging.info("Success, extracted {} reviews".format(len(final)))
+        SINK.write(finish_result(final, args.predict_labels, CACHE, INDEX, args.product, IMAGES))
     else:
-        DRIVER.quit()
-        final = None
         logging.error("Invalid mode or category")
         quit()
-    final["Date"] = pd.to_datetime(final["Date"], format="%b %d, %Y").map(lambda dt: dt.date())
-    if args.predict_labels:
-        final = predict_labels(final, TAGs, True)
-    file_name = df2excel(final, args.output)
+    file_name = SINK.close()
+    close_pipeline(INDEX, IMAGES, STATE)
+    # the journal is only dropped once the output and the watermarks are persisted
+    if args.mode == "category":
+        JOURNAL.clear()
+        JOURNAL.close()
+    if file_name is None:
+        logging.warning("No new reviews")
+        quit()
     logging.info("Process completed! File stored at {}".format(file_name))
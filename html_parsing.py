@@ -0,0 +1,20 @@
+from bs4 import BeautifulSoup, SoupStrainer
+import instrumentation
+
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+# only the review containers and the few elements read around them are built into the tree
+STRAINERS = {
+    "amazon": SoupStrainer(attrs={"data-hook": "review"}),
+    "homedepot": SoupStrainer(class_=["review_item", "page-title", "product-info-bar__detail--24WIp",
+                                      "pager-summary__bold"])
+}
+
+
+@instrumentation.timed("html_parse")
+def parse_page(page, site=None, parser=None):
+    return BeautifulSoup(page, parser or PARSER, parse_only=STRAINERS.get(site))
@@ -0,0 +1,114 @@
+import time
+import random
+import logging
+import threading
+from contextlib import nullcontext
+import requests
+from requests.adapters import HTTPAdapter
+import instrumentation
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+POOL_SIZE = 10
+TIMEOUT = 10
+_SESSION = None
+_ADAPTER = HTTPAdapter
+_LOCK = threading.Lock()
+
+
+class RetryBudgetExceeded(requests.RequestException):
+    pass
+
+
+class RetryBudget:
+    def __init__(self, retries=5, backoff=1.0, max_backoff=60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spent = 0
+
+    def wait(self, reason, retry_after=None):
+        if self.spent >= self.retries:
+            raise RetryBudgetExceeded("Retry budget of {} exhausted, last failure: {}".format(self.retries, reason))
+        # exponential backoff with full jitter, a Retry-After header from the server takes precedence
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** self.spent))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.spent += 1
+        instrumentation.count("retries")
+        logging.debug("Retry {}/{} in {:.1f}s after {}".format(self.spent, self.retries, delay, reason))
+        time.sleep(delay)
+
+
+def configure(pool_size=POOL_SIZE):
+    global _SESSION
+    session = requests.Session()
+    # one keep-alive pool per host, sized so that every worker can hold a connection
+    adapter = _ADAPTER(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    with _LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = session
+    return session
+
+
+def use_adapter(factory=HTTPAdapter):
+    """Build the connection adapters of the next sessions with factory, e.g. to record or replay the traffic"""
+    global _SESSION, _ADAPTER
+    with _LOCK:
+        _ADAPTER = factory
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+
+
+def get_session():
+    with _LOCK:
+        session = _SESSION
+    return session if session is not None else configure()
+
+
+def retry_after_seconds(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method, url, budget=None, limiter=None, slot=None, **kwargs):
+    """Send the request, retrying within budget; slot, e.g. the host slot of a fetch engine, is only held while a
+    request is in flight, so a request backing off does not keep other workers from the host"""
+    budget = budget if budget is not None else RetryBudget()
+    slot = slot if slot is not None else nullcontext()
+    kwargs.setdefault("timeout", TIMEOUT)
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            with slot, instrumentation.timer("http"):
+                response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            instrumentation.count("connection_errors")
+            if limiter is not None:
+                limiter.report(None)
+            budget.wait(error)
+            continue
+        instrumentation.count("requests")
+        instrumentation.count("bytes_fetched", len(response.content))
+        if limiter is not None:
+            limiter.report(response.status_code, time.monotonic() - start)
+        if response.status_code in RETRY_STATUS:
+            budget.wait("HTTP {} from {}".format(response.status_code, url), retry_after_seconds(response))
+            continue
+        response.raise_for_status()
+        return response
+
+
+def get(url, budget=None, limiter=None, slot=None, **kwargs):
+    return request("GET", url, budget, limiter, slot, **kwargs)
+
+
+def post(url, budget=None, limiter=None, slot=None, **kwargs):
+    return request("POST", url, budget, limiter, slot, **kwargs)
@@ -0,0 +1,106 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import mimetypes
+import threading
+from urllib.parse import urlparse
+import http_session
+import instrumentation
+from fetch_engine import FetchEngine, host_slot
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+
+
+def extension_of(url, content_type=None):
+    # the content type comes first, it names the format more reliably than the path of the URL
+    extension = mimetypes.guess_extension(content_type.split(";")[0].strip()) if content_type else None
+    if extension in IMAGE_EXTENSIONS:
+        return extension
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    return extension if extension in IMAGE_EXTENSIONS else ""
+
+
+class ImageStore:
+    """Local store of review images, every file is named by the SHA-256 of its content
+
+    An index maps every URL downloaded before to the file of its content, so an image is only downloaded once across
+    runs, and copies of one image under several URLs are stored once.
+    """
+    def __init__(self, path="images", workers=8, per_host=4, retries=3):
+        self.path = path
+        self.retries = retries
+        os.makedirs(path, exist_ok=True)
+        self.engine = FetchEngine(workers, per_host)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, "index.sqlite"))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, hash TEXT, file TEXT, "
+                                "fetched REAL)")
+        self.connection.commit()
+
+    def download(self, url):
+        """Fetch one image into the store, return its hash and its file relative to the store"""
+        response = http_session.get(url, http_session.RetryBudget(self.retries), slot=host_slot(self.engine, url))
+        digest = hashlib.sha256(response.content).hexdigest()
+        return digest, self.store(digest, response.content, extension_of(url, response.headers.get("Content-Type")))
+
+    def store(self, digest, content, extension):
+        """File of the content relative to the store, an existing file of the same digest is kept whatever its
+        extension, so content served under other types or URLs is stored once"""
+        directory = os.path.join(self.path, digest[:2])
+        with self.lock:
+            os.makedirs(directory, exist_ok=True)
+            for file_name in os.listdir(directory):
+                if os.path.splitext(file_name)[0] == digest:
+                    return os.path.join(digest[:2], file_name)
+            file_name = os.path.join(digest[:2], digest + extension)
+            path = os.path.join(self.path, file_name)
+            # written under a temporary name first, so an interrupted download never leaves a truncated image
+            temporary = "{}.{}.part".format(path, threading.get_ident())
+            with open(temporary, "wb") as f:
+                f.write(content)
+            os.replace(temporary, path)
+        return file_name
+
+    def known(self, urls, batch_size=500):
+        found = dict()
+        for i in range(0, len(urls), batch_size):
+            batch = urls[i:i + batch_size]
+            rows = self.connection.execute("SELECT url, file FROM images WHERE url IN ({})".format(
+                ", ".join("?" * len(batch))), batch).fetchall()
+            # images deleted from the store are downloaded again
+            found.update((url, os.path.join(self.path, file_name)) for url, file_name in rows
+                         if os.path.exists(os.path.join(self.path, file_name)))
+        return found
+
+    @instrumentation.timed("image_fetch")
+    def fetch(self, urls):
+        """Local file of every URL, the ones not in the index are downloaded concurrently; failed ones are left out"""
+        urls = list(dict.fromkeys(url for url in urls if url))
+        files = self.known(urls)
+        missing = [url for url in urls if url not in files]
+        instrumentation.count("images_reused", len(files))
+        fetched = []
+        for (url,), stored, error in self.engine.map(self.download, [(url,) for url in missing]):
+            if error is not None:
+                logging.warning("Failed to fetch image {}: {}".format(url, error))
+                instrumentation.count("image_errors")
+                continue
+            digest, file_name = stored
+            files[url] = os.path.join(self.path, file_name)
+            fetched.append((url, digest, file_name, time.time()))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)", fetched)
+        instrumentation.count("images_fetched", len(fetched))
+        return files
+
+    def localize(self, result, column="Image"):
+        """Add an "Image Files" column with the local files of the images of every review, one per line"""
+        urls = [value.split("\n") if type(value) == str and value else [] for value in result[column]]
+        files = self.fetch(url for row in urls for url in row)
+        result["Image Files"] = ["\n".join(files[url] for url in row if url in files) for row in urls]
+        return result
+
+    def close(self):
+        self.connection.close()
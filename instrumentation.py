@@ -0,0 +1,138 @@
+import json
+import math
+import time
+import datetime
+import functools
+import threading
+from contextlib import contextmanager
+
+PREFIX = "review_scraper"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    # nearest rank
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.timings = dict()
+        self.counters = dict()
+        self.products = dict()
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def product(self, retailer, product, reviews, seconds):
+        with self.lock:
+            self.products[(retailer, str(product))] = (reviews, seconds)
+
+    def report(self):
+        with self.lock:
+            timings = {stage: list(values) for stage, values in self.timings.items()}
+            counters = dict(self.counters)
+            products = dict(self.products)
+        duration = time.time() - self.started
+        reviews = sum(n_reviews for n_reviews, _ in products.values())
+        return {
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "duration": duration,
+            "stages": {stage: {"count": len(values), "total": sum(values), "p50": percentile(values, 0.5),
+                               "p95": percentile(values, 0.95), "max": max(values)}
+                       for stage, values in sorted(timings.items())},
+            "counters": counters,
+            "products": [{"retailer": retailer, "product": product, "reviews": n_reviews, "seconds": seconds,
+                          "reviews_per_sec": n_reviews / seconds if seconds else None}
+                         for (retailer, product), (n_reviews, seconds) in products.items()],
+            "reviews": reviews,
+            "reviews_per_sec": reviews / duration if duration else None
+        }
+
+    def prometheus(self):
+        report = self.report()
+        lines = ["# TYPE {}_stage_seconds summary".format(PREFIX)]
+        for stage, stats in report["stages"].items():
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                lines.append("{}_stage_seconds{{stage=\"{}\",quantile=\"{}\"}} {}".format(
+                    PREFIX, escape(stage), quantile, stats[key]))
+            lines.append("{}_stage_seconds_sum{{stage=\"{}\"}} {}".format(PREFIX, escape(stage), stats["total"]))
+            lines.append("{}_stage_seconds_count{{stage=\"{}\"}} {}".format(PREFIX, escape(stage), stats["count"]))
+        lines.append("# TYPE {}_events_total counter".format(PREFIX))
+        for name, value in sorted(report["counters"].items()):
+            lines.append("{}_events_total{{name=\"{}\"}} {}".format(PREFIX, escape(name), value))
+        for metric in ("reviews", "seconds", "reviews_per_sec"):
+            lines.append("# TYPE {}_product_{} gauge".format(PREFIX, metric))
+            for product in report["products"]:
+                if product[metric] is not None:
+                    lines.append("{}_product_{}{{retailer=\"{}\",product=\"{}\"}} {}".format(
+                        PREFIX, metric, escape(product["retailer"]), escape(product["product"]), product[metric]))
+        lines.append("# TYPE {}_run_seconds gauge".format(PREFIX))
+        lines.append("{}_run_seconds {}".format(PREFIX, report["duration"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the run report to path.json and, in the Prometheus text format, to path.prom"""
+        with open(path + ".json", "w") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(path + ".prom", "w") as f:
+            f.write(self.prometheus())
+
+
+METRICS = Metrics()
+
+
+def timer(stage):
+    return METRICS.timer(stage)
+
+
+def count(name, value=1):
+    METRICS.count(name, value)
+
+
+def timed(stage):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def timed_product(retailer, key_index):
+    """Record the duration and the number of reviews of every product, identified by the argument at key_index"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            METRICS.record("product", seconds)
+            METRICS.product(retailer, args[key_index], len(result) if result is not None else 0, seconds)
+            return result
+        return wrapper
+    return decorate
+
+
+def write_report(path):
+    METRICS.write(path)
@@ -1,12 +1,20 @@
-import requests
 import pandas as pd
-import time
 import datetime
-import random
 import argparse
 import logging
 import json
+import functools
+import itertools
+from contextlib import closing
 from review_classification import predict_labels
+from file_output import open_sink, SINKS
+from fetch_engine import FetchEngine, host_slot, prefetch
+import http_session
+import instrumentation
+from pipeline import add_pipeline_arguments, open_pipeline, close_pipeline
+import rate_limiter
+from state_store import review_key
+from review_records import ReviewBatch
 
 URL_search = "https://www.lowes.com/rnr/r/get-by-product/{}/pdp/prod?sortMethod=SubmissionTime&sortDirection=desc&offset="
 HEADERS = {
@@ -16,40 +24,46 @@ HEADERS = {
 TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
 
 
-def extract(reviews, dates, ratings, titles, bodies, images, earliest=None):
+@instrumentation.timed("extract")
+def extract(reviews, batch, earliest=None, watermark=None):
     if not reviews:
         return False
     for review in reviews:
         date = review["SubmissionTime"][:10]
-        if earliest and datetime.datetime.strptime(date, "%Y-%m-%d").date() < earliest:
+        review_date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        if earliest and review_date < earliest:
             return False
-        dates.append(date)
-        ratings.append(review["Rating"])
-        titles.append(review["Title"])
-        bodies.append(review["ReviewText"])
-        images.append("\n".join(image["Sizes"]["normal"]["Url"] for image in review["Photos"]))
+        if watermark is not None:
+            key = review.get("Id") or review_key(date, review["Title"], review["ReviewText"])
+            if watermark.reached(review_date, key):
+                return False
+            watermark.observe(review_date, key)
+        batch.add(review_date, review["Rating"], review["Title"], review["ReviewText"],
+                  "\n".join(image["Sizes"]["normal"]["Url"] for image in review["Photos"]))
     return True
 
 
-def parse_product(model_no, url, day_lim=None):
+@instrumentation.timed_product("lowes", 1)
+def parse_product(model_no, url, day_lim=None, engine=None, retries=5, watermark=None, depth=1):
     product_id = url.split("/")[-1]
     url_search = URL_search.format(product_id)
-    HEADERS["referer"] = url
+    headers = dict(HEADERS, referer=url)
     earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
-    dates, ratings, titles, bodies, images = [], [], [], [], []
-    offset = 0
-    to_continue = True
-    while to_continue:
-        response = requests.get(url_search + str(offset), headers=HEADERS)
-        if response.status_code == 200:
-            reviews = response.json()["Results"]
-            to_continue = extract(reviews, dates, ratings, titles, bodies, images, earliest)
-            offset += 10
-        time.sleep(1 + random.random())
-    result = pd.DataFrame({"Date": dates, "Rating": ratings, "Title": titles, "Body": bodies, "Image": images})
-    result["Model No."] = model_no
-    result["Model Description"] = model2desc[model_no]
-    return result[["Model No.", "Model Description", "Date", "Rating", "Title", "Body", "Image"]]
+    batch = ReviewBatch()
+    budget = http_session.RetryBudget(retries)
+    limiter = rate_limiter.get_limiter(url_search)
+
+    def fetch_page(offset):
+        response = http_session.get(url_search + str(offset), budget, limiter, host_slot(engine, url_search),
+                                    headers=headers)
+        return response.json()["Results"]
+
+    # page offsets are known ahead, so up to depth pages are requested before the previous ones are extracted
+    with closing(prefetch(fetch_page, itertools.count(0, 10), depth)) as pages:
+        for reviews in pages:
+            if not extract(reviews, batch, earliest, watermark):
+                break
+    return batch.frame({"Model No.": model_no, "Model Description": model2desc[model_no]})
 
 
 if __name__ == "__main__":
@@ -58,27 +72,61 @@ if __name__ == "__main__":
                         help="Name of input .json file (default lowes_input)")
     parser.add_argument("--days", type=int, default=7, help="Limit of days before today (default 7)")
     parser.add_argument("--output", type=str, default="Lowes_Reviews",
-                        help="Name of output .xlsx file (default Lowes_Reviews)")
+                        help="Name of output file (default Lowes_Reviews)")
+    parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                        help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of products fetched concurrently (default 1)")
+    parser.add_argument("--host_workers", type=int, default=None,
+                        help="Limit of concurrent requests per host (default same as --workers)")
+    parser.add_argument("--pool_size", type=int, default=None,
+                        help="Size of the keep-alive connection pool per host "
+                             "(default --workers times --prefetch, at least 10)")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="Number of review pages of one product requested ahead (default 1)")
+    parser.add_argument("--retries", type=int, default=5, help="Limit of retries per product (default 5)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Initial requests per second to Lowe's, adapted to the responses (default 0.6)")
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
+    STATE, CACHE, INDEX, IMAGES = open_pipeline(args)
+    if args.rate:
+        rate_limiter.configure("lowes.com", rate=args.rate)
     logging.basicConfig(level=logging.INFO)
     with open(args.input + ".json") as f:
         data = json.load(f)
     urls, model2desc = data["urls"], data["model2desc"]
-    results = []
-    for MODEL, urls_to_do in urls.items():
-        logging.info("Getting model {}".format(MODEL))
-        for target_url in urls_to_do:
-            try:
-                results.append(parse_product(MODEL, target_url, args.days))
-                if results[-1] is not None and len(results[-1]) > 0:
-                    logging.info("Success: {}, extracted {} reviews".format(MODEL, len(results[-1])))
-                else:
-                    logging.warning("No new reviews: {}".format(target_url))
-            except Exception:
-                logging.error("Failed: {}".format(target_url))
-    final = pd.concat(results)
-    final.drop_duplicates(inplace=True)
-    final["Date"] = pd.to_datetime(final["Date"], format="%Y-%m-%d").map(lambda date_: date_.date())
-    final = predict_labels(final, TAGs, True)
-    final.to_excel("outputs/" + args.output + ".xlsx", header=True, index=False)
-    logging.info("Process completed!")
+    http_session.configure(args.pool_size or max(args.workers * args.prefetch, http_session.POOL_SIZE))
+    engine = FetchEngine(args.workers, args.host_workers)
+    jobs = [(MODEL, target_url, args.days, engine, args.retries,
+             STATE.watermark("lowes", target_url.split("/")[-1]) if STATE else None)
+            for MODEL, urls_to_do in urls.items() for target_url in urls_to_do]
+    SINK = open_sink(args.output, args.format)
+    seen_rows = set()
+    outcomes = engine.map(functools.partial(parse_product, depth=args.prefetch), jobs)
+    for (MODEL, target_url, *_, watermark), result, error in outcomes:
+        if error is not None:
+            logging.error("Failed: {}".format(target_url))
+            continue
+        if STATE:
+            STATE.stage("lowes", target_url.split("/")[-1], watermark)
+        if result is None or len(result) == 0:
+            logging.warning("No new reviews: {}".format(target_url))
+            continue
+        logging.info("Success: {}, extracted {} reviews".format(MODEL, len(result)))
+        # rows already written for another product are dropped, as drop_duplicates did over the whole output
+        hashes = pd.util.hash_pandas_object(result, index=False)
+        result = result[(~hashes.duplicated() & ~hashes.isin(seen_rows)).to_numpy()].copy()
+        seen_rows.update(hashes)
+        if INDEX:
+            result = INDEX.dedup(result, "lowes", target_url.split("/")[-1])
+        if len(result) == 0:
+            continue
+        if IMAGES:
+            result = IMAGES.localize(result)
+        SINK.write(predict_labels(result, TAGs, True, cache=CACHE))
+    file_name = SINK.close()
+    close_pipeline(INDEX, IMAGES, STATE)
+    if file_name is None:
+        logging.warning("No new reviews")
+    else:
+        logging.info("Process completed! File stored at {}".format(file_name))
@@ -0,0 +1,29 @@
+import time
+import sqlite3
+
+
+class MetadataCache:
+    def __init__(self, path="metadata.sqlite", ttl=7 * 24 * 3600):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (retailer TEXT, product TEXT, model_no TEXT, "
+                                "model_description TEXT, manufacturer TEXT, updated REAL, "
+                                "PRIMARY KEY (retailer, product))")
+        self.connection.commit()
+
+    def get(self, retailer, product):
+        """(model_no, model_description) of the product fetched within the TTL, None if stale or unknown"""
+        row = self.connection.execute("SELECT model_no, model_description, updated FROM metadata "
+                                      "WHERE retailer = ? AND product = ?", (retailer, product)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def put(self, retailer, product, model_no, model_description):
+        manufacturer = model_description.split()[0] if model_description.split() else None
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                                    (retailer, product, model_no, model_description, manufacturer, time.time()))
+
+    def close(self):
+        self.connection.close()
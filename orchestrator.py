@@ -0,0 +1,225 @@
+import json
+import atexit
+import argparse
+import datetime
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import amazon
+import homedepot
+import lowes
+import walmart
+import http_session
+import instrumentation
+import rate_limiter
+from review_classification import predict_labels
+from classification_cache import ClassificationCache
+from catalog_cache import CatalogCache
+from metadata_cache import MetadataCache
+from file_output import open_sink
+from state_store import StateStore
+from review_index import ReviewIndex
+from image_store import ImageStore
+from pipeline import close_pipeline
+from driver_pool import DriverPool, LazyDriver, new_driver
+from fetch_engine import FetchEngine
+from replay import start_recording, start_replay
+
+SITES = {"lowes": "lowes.com", "walmart": "walmart.com", "homedepot": "homedepot.com", "amazon": "amazon.com"}
+TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
+
+
+def watermark_of(state, retailer, product):
+    return state.watermark(retailer, product) if state else None
+
+
+def discover(retailer, settings, driver, parse):
+    catalog = CatalogCache(settings.get("catalog", "catalog.sqlite"), settings.get("catalog_ttl", 24) * 3600)
+    targets = catalog.get(retailer, settings["category"])
+    if targets is None:
+        targets = parse(driver(), settings["category"])
+        catalog.put(retailer, settings["category"], targets)
+    catalog.close()
+    return targets
+
+
+def run_lowes(settings, days, state):
+    with open(settings.get("input", "lowes_input") + ".json") as f:
+        data = json.load(f)
+    lowes.model2desc = data["model2desc"]
+    engine = FetchEngine(settings.get("workers", 1), settings.get("host_workers"))
+    jobs = [(model, url, days, engine, settings.get("retries", 5),
+             watermark_of(state, "lowes", url.split("/")[-1]))
+            for model, urls in data["urls"].items() for url in urls]
+    outcomes = engine.map(functools.partial(lowes.parse_product, depth=settings.get("prefetch", 1)), jobs)
+    for (_, url, *_, watermark), result, error in outcomes:
+        yield url.split("/")[-1], url, result, error, watermark
+
+
+def run_walmart(settings, days, state):
+    driver = LazyDriver(functools.partial(new_driver, settings.get("headless", False)))
+    interactive = not settings.get("headless", False)
+    metadata = MetadataCache(settings.get("metadata", "metadata.sqlite"), settings.get("metadata_ttl", 168) * 3600)
+    try:
+        targets = discover("walmart", settings, driver,
+                           lambda driver_, category: walmart.parse_content(driver_, walmart.URLs[category], category,
+                                                                           interactive))
+        with FetchEngine(settings.get("workers", 1), settings.get("host_workers")) as engine:
+            pending = []
+            for product_id, url in targets:
+                watermark = watermark_of(state, "walmart", product_id)
+                try:
+                    model = walmart.load_metadata(driver, product_id, url, metadata, interactive)
+                except Exception as error:
+                    yield product_id, url, None, error, watermark
+                    continue
+                pending.append((product_id, url, model, watermark, engine.submit(
+                    walmart.fetch_reviews, product_id, days, engine, settings.get("retries", 5), watermark,
+                    settings.get("prefetch", 1))))
+            for product_id, url, model, watermark, future in pending:
+                try:
+                    yield product_id, url, walmart.build_result(future.result(), *model), None, watermark
+                except Exception as error:
+                    yield product_id, url, None, error, watermark
+    finally:
+        metadata.close()
+        driver.close()
+
+
+def run_homedepot(settings, days, state):
+    factory = functools.partial(new_driver, settings.get("headless", False))
+    browser = LazyDriver(factory)
+    targets = discover("homedepot", settings, browser,
+                       lambda driver_, category: homedepot.parse_content(driver_, homedepot.URLs[category]))
+    browser.close()
+    urls = ["https://www.homedepot.com/p/reviews" + target[2:] for target in targets]
+    jobs = [(url, days, False, watermark_of(state, "homedepot", url)) for url in urls]
+    interactive = not settings.get("headless", False)
+    if settings.get("engine", "selenium") == "http":
+        pool = LazyDriver(factory)
+        engine = FetchEngine(settings.get("workers", 1), settings.get("host_workers"))
+        outcomes = engine.map(functools.partial(homedepot.fetch_product, fallback=pool, retries=settings.get(
+            "retries", 5), engine=engine, interactive=interactive), jobs)
+    else:
+        pool = DriverPool(settings.get("drivers", 1), factory)
+        outcomes = pool.map(functools.partial(homedepot.parse_product, interactive=interactive), jobs)
+    try:
+        for (url, *_, watermark), result, error in outcomes:
+            yield url, url, result, error, watermark
+    finally:
+        pool.close()
+
+
+def run_amazon(settings, days, state):
+    with open(settings.get("input", "amazon_input") + ".json") as f:
+        data = json.load(f)
+    amazon.size2model, amazon.model2desc = data["size2model"], data["model2desc"]
+    urls = data["urls"][settings["category"]]
+    targets = [(urls, None)] if type(urls) == str else [(url, model) for model, url in urls.items()]
+    jobs = [(url, model, days, watermark_of(state, "amazon", url)) for url, model in targets]
+    factory = functools.partial(new_driver, settings.get("headless", False))
+    interactive = not settings.get("headless", False)
+    if settings.get("engine", "selenium") == "http":
+        pool = LazyDriver(factory)
+        engine = FetchEngine(settings.get("workers", 1), settings.get("host_workers"))
+        outcomes = engine.map(functools.partial(amazon.fetch_product, fallback=pool, retries=settings.get(
+            "retries", 5), engine=engine, interactive=interactive), jobs)
+    else:
+        pool = DriverPool(settings.get("drivers", 1), factory)
+        outcomes = pool.map(functools.partial(amazon.parse_product, interactive=interactive), jobs)
+    try:
+        for (url, *_, watermark), result, error in outcomes:
+            yield url, url, result, error, watermark
+    finally:
+        pool.close()
+
+
+RUNNERS = {"lowes": run_lowes, "walmart": run_walmart, "homedepot": run_homedepot, "amazon": run_amazon}
+
+
+def crawl(retailer, settings, days, state_path=None):
+    """Run the products of one retailer, return its non-empty (product, result) and the watermarks to stage"""
+    if settings.get("rate"):
+        rate_limiter.configure(SITES[retailer], rate=settings["rate"])
+    # sqlite connections stay in the thread that opened them, so every retailer reads its own
+    state = StateStore(state_path) if state_path else None
+    results, watermarks = [], []
+    try:
+        for product, url, result, error, watermark in RUNNERS[retailer](settings, days, state):
+            if error is not None:
+                logging.error("{} failed: {}".format(retailer, url))
+                continue
+            watermarks.append((product, watermark))
+            if result is None or len(result) == 0:
+                logging.warning("{} no new reviews: {}".format(retailer, url))
+                continue
+            logging.info("{} success: {}, extracted {} reviews".format(retailer, url, len(result)))
+            result.insert(0, "Retailer", retailer)
+            results.append((product, result))
+    finally:
+        if state:
+            state.close()
+    return results, watermarks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract customer reviews from all retailers in one run")
+    parser.add_argument("--config", type=str, default="orchestrator.json",
+                        help="JSON file with the run options and one section per retailer (default orchestrator.json)")
+    args = parser.parse_args()
+    with open(args.config) as f:
+        CONFIG = json.load(f)
+    logging.basicConfig(level=logging.INFO)
+    if CONFIG.get("report"):
+        atexit.register(instrumentation.write_report, CONFIG["report"])
+    if CONFIG.get("record"):
+        start_recording(CONFIG["record"])
+    elif CONFIG.get("replay"):
+        start_replay(CONFIG["replay"])
+    RETAILERS = {retailer: settings for retailer, settings in CONFIG["retailers"].items() if retailer in RUNNERS}
+    POOL_SIZE = sum(settings.get("workers", 1) * settings.get("prefetch", 1) for settings in RETAILERS.values())
+    http_session.configure(max(POOL_SIZE, http_session.POOL_SIZE))
+    STATE_PATH = CONFIG.get("state", "state.sqlite") if CONFIG.get("incremental") else None
+    START = datetime.datetime.now()
+    # the retailers are paced by their own rate limiters, so they are crawled side by side
+    with ThreadPoolExecutor(max_workers=len(RETAILERS)) as executor:
+        futures = {retailer: executor.submit(crawl, retailer, settings, CONFIG.get("days", 7), STATE_PATH)
+                   for retailer, settings in RETAILERS.items()}
+    RESULTS, WATERMARKS = [], []
+    for retailer, future in futures.items():
+        try:
+            results, watermarks = future.result()
+        except Exception:
+            logging.exception("{} stopped".format(retailer))
+            continue
+        RESULTS.extend((retailer, product, result) for product, result in results)
+        WATERMARKS.extend((retailer, product, watermark) for product, watermark in watermarks)
+    logging.info("Crawled {} retailers in {}".format(len(RETAILERS), datetime.datetime.now() - START))
+    INDEX = ReviewIndex(CONFIG.get("index", "review_index.sqlite"), flag=CONFIG.get("flag_duplicates", False)) \
+        if CONFIG.get("dedup") else None
+    if INDEX:
+        # syndicated reviews are dropped before they are classified, whichever retailer they were crawled from
+        RESULTS = [(retailer, product, INDEX.dedup(result, retailer, product))
+                   for retailer, product, result in RESULTS]
+    RESULTS = [result for _, _, result in RESULTS if len(result) > 0]
+    if not RESULTS:
+        logging.warning("No new reviews")
+        quit()
+    final = pd.concat(RESULTS, ignore_index=True)
+    if CONFIG.get("images"):
+        IMAGES = ImageStore(CONFIG["images"], CONFIG.get("image_workers", 8))
+        final = IMAGES.localize(final)
+        IMAGES.close()
+    if CONFIG.get("predict_labels", True):
+        final = predict_labels(final, TAGs, True, workers=CONFIG.get("label_workers", 1),
+                               cache=ClassificationCache() if CONFIG.get("cache_labels") else None)
+    SINK = open_sink(CONFIG.get("output", "All_Reviews"), CONFIG.get("format", "xlsx"))
+    SINK.write(final)
+    file_name = SINK.close()
+    STATE = StateStore(STATE_PATH) if STATE_PATH else None
+    if STATE:
+        for retailer, product, watermark in WATERMARKS:
+            STATE.stage(retailer, product, watermark)
+    close_pipeline(INDEX, state=STATE)
+    logging.info("Process completed! {} reviews stored at {}".format(len(final), file_name))
@@ -0,0 +1,73 @@
+import atexit
+import instrumentation
+from classification_cache import ClassificationCache
+from state_store import StateStore
+from review_index import ReviewIndex
+from image_store import ImageStore
+from replay import start_recording, start_replay
+
+
+def add_pipeline_arguments(parser):
+    """Options shared by the scrapers: incremental state, cached labels, fixtures, the run report and the outputs"""
+    parser.add_argument("--incremental", action="store_true",
+                        help="Stop at reviews already extracted by previous incremental runs")
+    parser.add_argument("--state", type=str, default="state.sqlite",
+                        help="Path of the state store for incremental runs (default state.sqlite)")
+    parser.add_argument("--cache_labels", action="store_true",
+                        help="Reuse labels predicted for the same reviews in previous runs")
+    parser.add_argument("--record", type=str, default=None,
+                        help="Directory to save the HTTP responses and page sources of this run into as fixtures")
+    parser.add_argument("--replay", type=str, default=None,
+                        help="Directory of fixtures to answer the HTTP requests from instead of the network")
+    parser.add_argument("--report", type=str, default=None,
+                        help="Path to write the timing report of the run to, as PATH.json and PATH.prom (Prometheus)")
+    add_output_arguments(parser)
+
+
+def add_output_arguments(parser):
+    """Options of the written reviews, shared by the scrapers and work_queue.py collect"""
+    parser.add_argument("--dedup", action="store_true",
+                        help="Drop reviews identical or nearly identical to ones written by earlier runs or for other "
+                             "products and retailers")
+    parser.add_argument("--index", type=str, default="review_index.sqlite",
+                        help="Path of the index of written reviews used by --dedup (default review_index.sqlite)")
+    parser.add_argument("--flag_duplicates", action="store_true",
+                        help="With --dedup, keep the duplicates and name their original in a Duplicate Of column")
+    parser.add_argument("--images", type=str, default=None,
+                        help="Directory to download the review images into, each image once across runs; their local "
+                             "files are listed in an Image Files column")
+    parser.add_argument("--image_workers", type=int, default=8,
+                        help="Number of images downloaded concurrently (default 8)")
+
+
+def open_outputs(args):
+    """Review index and image store of the options of add_output_arguments, None for those not used"""
+    index = ReviewIndex(args.index, flag=args.flag_duplicates) if args.dedup else None
+    images = ImageStore(args.images, args.image_workers) if args.images else None
+    return index, images
+
+
+def open_pipeline(args, predict=True):
+    """Start recording or replaying fixtures and the run report, return the state store, the label cache, the
+    review index and the image store of the options of add_pipeline_arguments, None for those not used"""
+    if args.report:
+        atexit.register(instrumentation.write_report, args.report)
+    if args.record:
+        start_recording(args.record)
+    elif args.replay:
+        start_replay(args.replay)
+    state = StateStore(args.state) if args.incremental else None
+    cache = ClassificationCache() if predict and args.cache_labels else None
+    return (state, cache) + open_outputs(args)
+
+
+def close_pipeline(index=None, images=None, state=None):
+    """Persist the indexed reviews and the watermarks once the output is complete, and close the stores"""
+    if index is not None:
+        index.commit()
+        index.close()
+    if images is not None:
+        images.close()
+    if state is not None:
+        state.commit()
+        state.close()
@@ -0,0 +1,92 @@
+import time
+import random
+import threading
+from urllib.parse import urlparse
+import instrumentation
+
+SITE_LIMITS = {
+    "homedepot.com": {"rate": 0.6, "max_rate": 1.0},
+    "walmart.com": {"rate": 0.6, "max_rate": 4.0},
+    "amazon.com": {"rate": 0.6, "max_rate": 1.0},
+    "lowes.com": {"rate": 0.6, "max_rate": 4.0}
+}
+THROTTLE_STATUS = {429, 503}
+_LIMITERS = dict()
+_LOCK = threading.Lock()
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate=0.6, min_rate=0.05, max_rate=2.0, burst=1, increase=0.05, decrease=0.5,
+                 slow_latency=3.0, cooldown=30.0, jitter=0.3):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.cooldown = cooldown
+        self.jitter = jitter
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @instrumentation.timed("rate_limit_wait")
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay * (1 + random.uniform(0, self.jitter)))
+
+    def report(self, status=200, latency=None):
+        # additive increase while responses are healthy, multiplicative decrease otherwise
+        with self.lock:
+            if status in THROTTLE_STATUS:
+                self._throttle()
+            elif status is None or status >= 500:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            elif latency is not None and latency > self.slow_latency:
+                self.rate = max(self.min_rate, self.rate * (1 + self.decrease) / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def report_blocked(self):
+        with self.lock:
+            self._throttle()
+
+    def _throttle(self):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0
+        self.blocked_until = time.monotonic() + self.cooldown
+
+
+def site_of(url):
+    host = urlparse(url).netloc if "://" in url else url
+    for site in SITE_LIMITS:
+        if host == site or host.endswith("." + site):
+            return site
+    return host
+
+
+def configure(site, **limits):
+    with _LOCK:
+        SITE_LIMITS[site] = dict(SITE_LIMITS.get(site, dict()), **limits)
+        _LIMITERS.pop(site, None)
+
+
+def get_limiter(url):
+    site = site_of(url)
+    with _LOCK:
+        if site not in _LIMITERS:
+            _LIMITERS[site] = AdaptiveRateLimiter(**SITE_LIMITS.get(site, dict()))
+        return _LIMITERS[site]
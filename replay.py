@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import functools
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+import http_session
+import driver_pool
+import rate_limiter
+
+# the recorded body is already decoded, so the headers describing the encoding on the wire are dropped
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+class FixtureMissing(requests.RequestException):
+    pass
+
+
+def fixture_key(method, url, body=None):
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.sha1(method.encode() + b"\x1f" + url.encode() + b"\x1f" + (body or b"")).hexdigest()
+
+
+class FixtureStore:
+    def __init__(self, path="fixtures"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _save(self, key, meta, content):
+        with open(os.path.join(self.path, key + ".body"), "wb") as f:
+            f.write(content)
+        # the metadata is written last, so entries() never lists a fixture whose body is incomplete
+        with open(os.path.join(self.path, key + ".json"), "w") as f:
+            json.dump(dict(meta, key=key), f)
+
+    def save_response(self, method, url, body, status, headers, content):
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", "replace")
+        headers = {name: value for name, value in headers.items() if name.lower() not in DROPPED_HEADERS}
+        meta = {"kind": "http", "site": rate_limiter.site_of(url), "method": method, "url": url, "body": body,
+                "status": status, "headers": headers}
+        self._save(fixture_key(method, url, body), meta, content)
+
+    def load_response(self, method, url, body=None):
+        key = fixture_key(method, url, body)
+        try:
+            with open(os.path.join(self.path, key + ".json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise FixtureMissing("No fixture recorded for {} {}".format(method, url))
+        return meta, self.content(meta)
+
+    def save_page(self, url, page):
+        # page sources are keyed by content, as pages reached by clicking share the URL of the first one
+        content = page.encode()
+        meta = {"kind": "page", "site": rate_limiter.site_of(url), "url": url}
+        self._save(hashlib.sha1(content).hexdigest(), meta, content)
+
+    def entries(self, kind=None, site=None):
+        for file_name in sorted(os.listdir(self.path)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.path, file_name)) as f:
+                    meta = json.load(f)
+                if (kind is None or meta["kind"] == kind) and (site is None or meta["site"] == site):
+                    yield meta
+
+    def content(self, meta):
+        with open(os.path.join(self.path, meta["key"] + ".body"), "rb") as f:
+            return f.read()
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, store, **kwargs):
+        self.store = store
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.store.save_response(request.method, request.url, request.body, response.status_code,
+                                 response.headers, response.content)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, store, **kwargs):
+        # pool options of the live adapter are accepted and ignored
+        super().__init__()
+        self.store = store
+
+    def send(self, request, **kwargs):
+        meta, content = self.store.load_response(request.method, request.url, request.body)
+        response = requests.Response()
+        response.status_code = meta["status"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response._content = content
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordingDriver:
+    def __init__(self, store, driver):
+        self.store = store
+        self.driver = driver
+
+    @property
+    def page_source(self):
+        page = self.driver.page_source
+        self.store.save_page(self.driver.current_url, page)
+        return page
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+
+def start_recording(path="fixtures"):
+    """Save every HTTP response and every page source read from a browser into the fixture store at path"""
+    store = FixtureStore(path)
+    http_session.use_adapter(functools.partial(RecordingAdapter, store))
+    driver_pool.wrap_drivers(functools.partial(RecordingDriver, store))
+    return store
+
+
+def start_replay(path="fixtures"):
+    """Answer every HTTP request from the fixture store at path instead of the network"""
+    store = FixtureStore(path)
+    http_session.use_adapter(functools.partial(ReplayAdapter, store))
+    # nothing reaches the sites, so requests are not paced
+    for site in list(rate_limiter.SITE_LIMITS):
+        rate_limiter.configure(site, rate=1e9, max_rate=1e9, burst=1e9)
+    return store
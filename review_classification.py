@@ -1,11 +1,20 @@
+import os
 import re
+import time
 import pickle
+import logging
+import argparse
+import datetime
+import functools
+import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
-from sklearn.naive_bayes import MultinomialNB
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem.porter import PorterStemmer
+from classification_cache import content_key, text_key, TextCache
+import instrumentation
+from file_output import open_sink, SINKS
 
 KEYWORDS_DICT = {
     "8.8 error code": re.compile("blink.+?88|beep.+?88|flash.+?88|88.+?error|8\\.8"),
@@ -14,95 +23,405 @@ KEYWORDS_DICT = {
     "used unit": re.compile("used\\s+(?:unit|item)|(?:be|was|were)[a-z\\s]+used|previous\\s+return|repackage|restock"),
     "wifi": re.compile("wifi|wi-fi")
 }
-STOPWORDS = stopwords.words("english")
-for negation in ("not", "no", "don", "don't", "aren", "aren't", "didn", "didn't", "doesn", "doesn't", "isn", "isn't"):
-    STOPWORDS.remove(negation)
+NEGATIONS = ("not", "no", "don", "don't", "aren", "aren't", "didn", "didn't", "doesn", "doesn't", "isn", "isn't")
+# on text made of letters and spaces only, word_tokenize just splits on whitespace and these contractions
+CONTRACTIONS = {"cannot": ("can", "not"), "gimme": ("gim", "me"), "gonna": ("gon", "na"), "gotta": ("got", "ta"),
+                "lemme": ("lem", "me"), "wanna": ("wan", "na")}
+NON_LETTERS = re.compile("[^A-Za-z]")
+STEM_CACHE_SIZE = 100000
+MODEL_BUNDLE = "review_classification/model_bundle.pkl"
+TEXT_CACHE = "review_classification/text_cache.sqlite"
+# cached texts are keyed by this version, bump it whenever clean_text changes its output
+PREPROCESSING_VERSION = "1"
+HASHING_FEATURES = 2 ** 18
+TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
+_BUNDLES = dict()
 
 
-def process_text(review, stemmer=PorterStemmer()):
-    title, text = review["Title"], review["Body"]
+# NLTK is only imported once text is actually preprocessed
+@functools.lru_cache(maxsize=None)
+def get_stopwords():
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words("english")).difference(NEGATIONS)
+
+
+@functools.lru_cache(maxsize=None)
+def get_stemmer():
+    from nltk.stem.porter import PorterStemmer
+    return PorterStemmer()
+
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    return get_stemmer().stem(word)
+
+
+def tokenize(text):
+    for word in text.split():
+        yield from CONTRACTIONS.get(word, (word,))
+
+
+def clean_text(title, text):
     title = "" if type(title) != str else title
     text = "" if type(text) != str else text
     if not (title.endswith("...") and title[:-3] in text):
         text = " ".join((title, text))
-    text = re.sub("[^A-Za-z]", " ", text.lower())
-    tokenized_text = word_tokenize(text)
-    clean_text = [stemmer.stem(word) for word in tokenized_text if word not in STOPWORDS]
-    return " ".join(clean_text)
+    text = NON_LETTERS.sub(" ", text.lower())
+    stopwords = get_stopwords()
+    return " ".join(stem(word) for word in tokenize(text) if word not in stopwords)
+
+
+def process_text(review):
+    return clean_text(review["Title"], review["Body"])
+
+
+def process_chunk(rows):
+    return [clean_text(title, text) for title, text in rows]
 
 
-def vectorize(labeled_data):
-    training_text = labeled_data.apply(process_text, axis=1)
+def process_texts(data, workers=1, chunk_size=20000):
+    rows = list(zip(data["Title"], data["Body"]))
+    if workers > 1 and len(rows) > chunk_size:
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            processed = [text for chunk in executor.map(process_chunk, chunks) for text in chunk]
+    else:
+        processed = process_chunk(rows)
+    return pd.Series(processed, index=data.index, dtype=object)
+
+
+def cached_texts(data, cache, workers=1):
+    """Preprocessed texts of data, only the reviews missing from the cache are processed and then stored"""
+    keys = [text_key(title, body, PREPROCESSING_VERSION) for title, body in zip(data["Title"], data["Body"])]
+    found = cache.get_many(keys)
+    missed = [i for i, key in enumerate(keys) if key not in found]
+    if missed:
+        texts = process_texts(data.iloc[missed], workers)
+        cache.put_many(zip((keys[i] for i in missed), texts))
+        found.update(zip((keys[i] for i in missed), texts))
+    return pd.Series([found[key] for key in keys], index=data.index, dtype=object)
+
+
+def vectorize(labeled_data, cache=None, workers=1):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    if cache is None:
+        training_text = process_texts(labeled_data, workers)
+    else:
+        training_text = cached_texts(labeled_data, cache, workers)
     vectorizer = TfidfVectorizer(ngram_range=(1, 2), max_features=300)
     vectors = vectorizer.fit_transform(training_text)
-    with open("review_classification/text_vectorizer.vec", "wb") as vectorizer_file:
-        pickle.dump(vectorizer, vectorizer_file)
     return vectorizer, vectors
 
 
 def train_separate_model(labeled_data, vectors, tag):
+    from sklearn.naive_bayes import MultinomialNB
     nb_classifier = MultinomialNB()
     nb_classifier.fit(vectors, labeled_data[tag])
-    with open("review_classification/classifier for " + tag + ".model", "wb") as model_file:
-        pickle.dump(nb_classifier, model_file)
     return nb_classifier
 
 
-def train_models(tags_to_train, training_data_path="review_classification/training_data.csv"):
+def save_bundle(vectorizer, models, path=MODEL_BUNDLE, rows=None):
+    artifacts = pickle.dumps((vectorizer, models))
+    bundle = {"version": hashlib.sha256(artifacts).hexdigest(), "vectorizer": vectorizer, "models": models,
+              "trained": datetime.datetime.now().isoformat(timespec="seconds")}
+    if rows is not None:
+        # keys of the labeled rows the classifiers were fitted on, an incremental update skips them
+        bundle["rows"] = rows
+    with open(path, "wb") as bundle_file:
+        pickle.dump(bundle, bundle_file)
+    return bundle
+
+
+def load_labeled(training_data_path):
+    from sklearn.feature_extraction.text import CountVectorizer
     data = pd.read_csv(training_data_path)
     data["Category"] = data["Category"].map(lambda cat: cat.strip().lower() if type(cat) == str else "")
-    split_tags = CountVectorizer(tokenizer=lambda x: re.split("\\s+/\\s+", x), binary=True)
-    tags = pd.DataFrame(split_tags.fit_transform(data["Category"]).toarray(), columns=split_tags.get_feature_names())
-    tags.drop(columns=[""], inplace=True)
-    labeled = data.join(tags)[data["Category"] != ""]
-    vectorizer, vectors = vectorize(labeled)
-    return vectorizer, {tag: train_separate_model(labeled, vectors, tag) for tag in tags_to_train}
+    split_tags = CountVectorizer(tokenizer=lambda x: re.split("\\s+/\\s+", x), token_pattern=None, binary=True)
+    tags = pd.DataFrame(split_tags.fit_transform(data["Category"]).toarray(),
+                        columns=split_tags.get_feature_names_out(), index=data.index)
+    tags.drop(columns=[""], inplace=True, errors="ignore")
+    return data.join(tags)[data["Category"] != ""]
 
 
-def predict_labels(unlabeled_data, candidate_tags, one_hot_encoding=False):
-    columns = unlabeled_data.columns.to_list()
-    processed_text = unlabeled_data.apply(process_text, axis=1)
-    tags_ml = set()
-
-    def rule_based(review, pattern):
-        if review["Rating"] >= 3:
-            return 0
-        title, text = review["Title"], review["Body"]
-        if type(title) == str and re.search(pattern, title.lower()):
-            return 1
-        if type(text) == str and re.search(pattern, text.lower()):
-            return 1
-        return 0
+def row_key(title, body, category):
+    fields = ("" if type(title) != str else title, "" if type(body) != str else body, category)
+    return hashlib.sha1("\x1f".join(fields).encode()).hexdigest()
 
-    for tag in candidate_tags:
-        if tag in KEYWORDS_DICT:
-            unlabeled_data[tag] = unlabeled_data.apply(rule_based, args=(KEYWORDS_DICT[tag],), axis=1)
-        else:
-            tags_ml.add(tag)
+
+def train_models(tags_to_train, training_data_path="review_classification/training_data.csv", path=MODEL_BUNDLE,
+                 workers=1):
+    labeled = load_labeled(training_data_path)
+    cache = TextCache(TEXT_CACHE)
     try:
-        with open("review_classification/text_vectorizer.vec", "rb") as vectorizer_file:
-            vectorizer = pickle.load(vectorizer_file)
-        models = dict()
+        vectorizer, vectors = vectorize(labeled, cache, workers)
+    finally:
+        cache.close()
+    models = {tag: train_separate_model(labeled, vectors, tag) for tag in tags_to_train}
+    save_bundle(vectorizer, models, path)
+    return vectorizer, models
+
+
+def update_models(tags_to_train, training_data_path="review_classification/training_data.csv", path=MODEL_BUNDLE,
+                  workers=1):
+    """Fit the classifiers with partial_fit on the labeled rows they have not seen yet
+
+    Texts are hashed into a fixed feature space, so the vectors of earlier rows stay valid and an update only
+    preprocesses, vectorizes and fits the rows added to the training data since the last one. Classifiers for tags
+    new to the bundle are fitted on every row.
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    bundle = None
+    if os.path.exists(path):
+        with open(path, "rb") as bundle_file:
+            bundle = pickle.load(bundle_file)
+        if not isinstance(bundle["vectorizer"], HashingVectorizer):
+            raise ValueError("Model bundle {} has a fitted vocabulary and cannot be updated, move it away to start an "
+                             "incremental one".format(path))
+        vectorizer, models, rows = bundle["vectorizer"], dict(bundle["models"]), set(bundle["rows"])
+    else:
+        # raw counts without sign flipping, as MultinomialNB expects non-negative term frequencies
+        vectorizer = HashingVectorizer(ngram_range=(1, 2), n_features=HASHING_FEATURES, alternate_sign=False,
+                                       norm=None)
+        models, rows = dict(), set()
+    labeled = load_labeled(training_data_path)
+    keys = [row_key(title, body, category)
+            for title, body, category in zip(labeled["Title"], labeled["Body"], labeled["Category"])]
+    unseen = np.array([key not in rows for key in keys], dtype=bool)
+    new_tags = [tag for tag in tags_to_train if tag not in models]
+    fitted = np.ones(len(labeled), dtype=bool) if new_tags else unseen
+    if fitted.any():
+        cache = TextCache(TEXT_CACHE)
+        try:
+            vectors = vectorizer.transform(cached_texts(labeled[fitted], cache, workers))
+        finally:
+            cache.close()
+        for tag in new_tags:
+            # the default smoothing would outweigh the counts spread over the large hashed feature space
+            models[tag] = MultinomialNB(alpha=0.1)
+            models[tag].partial_fit(vectors, labeled[tag][fitted], classes=[0, 1])
+        # the classifiers already in the bundle keep being updated, also for tags not given this time
+        update = unseen[fitted]
+        if update.any():
+            for tag, model in models.items():
+                if tag not in new_tags:
+                    model.partial_fit(vectors[update], labeled[tag][fitted][update])
+    logging.info("Fitted {} new labeled rows out of {}".format(int(unseen.sum()), len(labeled)))
+    save_bundle(vectorizer, models, path, rows.union(keys))
+    return vectorizer, models
+
+
+def load_legacy_bundle(tags):
+    # artifacts written before the bundle existed: one vectorizer file and one file per classifier
+    paths = ["review_classification/text_vectorizer.vec"] + \
+        ["review_classification/classifier for " + tag + ".model" for tag in sorted(tags)]
+    artifacts = []
+    for path in paths:
+        with open(path, "rb") as artifact_file:
+            artifacts.append(artifact_file.read())
+    version = hashlib.sha256(b"".join(hashlib.sha256(artifact).digest() for artifact in artifacts)).hexdigest()
+    return {"version": version, "vectorizer": pickle.loads(artifacts[0]),
+            "models": dict(zip(sorted(tags), (pickle.loads(artifact) for artifact in artifacts[1:])))}
+
+
+def load_bundle(tags=(), path=MODEL_BUNDLE):
+    """Load the model bundle once per process, reloaded only when the file is rewritten"""
+    start = time.perf_counter()
+    if os.path.exists(path):
+        key = (path, os.stat(path).st_mtime_ns)
+        if key not in _BUNDLES:
+            with open(path, "rb") as bundle_file:
+                _BUNDLES[key] = pickle.load(bundle_file)
+            logging.info("Loaded model bundle {} in {:.2f}s".format(path, time.perf_counter() - start))
+    else:
+        key = ("legacy", tuple(sorted(tags)))
+        if key not in _BUNDLES:
+            try:
+                _BUNDLES[key] = load_legacy_bundle(tags)
+            except FileNotFoundError:
+                raise FileNotFoundError("No trained models for {}, run `python review_classification.py train` "
+                                        "first".format(", ".join(sorted(tags))))
+            logging.info("Loaded legacy model files in {:.2f}s".format(time.perf_counter() - start))
+    bundle = _BUNDLES[key]
+    missing = set(tags).difference(bundle["models"])
+    if missing:
+        raise KeyError("Model bundle has no classifier for {}, retrain it with these tags".format(
+            ", ".join(sorted(missing))))
+    return bundle
+
+
+def lower_texts(texts):
+    return [text.lower() if type(text) == str else None for text in texts]
+
+
+def rule_based_labels(titles, bodies, negative, tags):
+    labels = {tag: np.zeros(len(titles), dtype=int) for tag in tags}
+    if not tags:
+        return labels
+    any_keyword = re.compile("|".join("(?:{})".format(KEYWORDS_DICT[tag].pattern) for tag in tags))
+    for i in np.flatnonzero(negative):
+        texts = [text for text in (titles[i], bodies[i]) if text is not None]
+        # one combined scan rules out most reviews, the tags are only told apart on a hit
+        if not any(any_keyword.search(text) for text in texts):
+            continue
+        for tag in tags:
+            if any(KEYWORDS_DICT[tag].search(text) for text in texts):
+                labels[tag][i] = 1
+    return labels
+
+
+def predict_labels(unlabeled_data, candidate_tags, one_hot_encoding=False, workers=1, cache=None, path=MODEL_BUNDLE):
+    columns = unlabeled_data.columns.to_list()
+    negative = ~(pd.to_numeric(unlabeled_data["Rating"], errors="coerce").to_numpy() >= 3)
+    bodies = unlabeled_data["Body"]
+    empty_body = (bodies.isna() | bodies.isin(("", "Rating provided by a verified purchaser"))).to_numpy()
+    tags_rule = [tag for tag in candidate_tags if tag in KEYWORDS_DICT]
+    tags_ml = set(tag for tag in candidate_tags if tag not in KEYWORDS_DICT)
+    with instrumentation.timer("rule_labels"):
+        labels = rule_based_labels(lower_texts(unlabeled_data["Title"]), lower_texts(bodies), negative, tags_rule)
+    if tags_ml:
+        bundle = load_bundle(tags_ml, path)
+        keys = [content_key(title, body, rating, bundle["version"]) for title, body, rating in
+                zip(unlabeled_data["Title"], bodies, pd.to_numeric(unlabeled_data["Rating"], errors="coerce"))]
+        cached = cache.get_many(keys) if cache is not None else dict()
+        missed = [i for i, key in enumerate(keys) if not tags_ml.issubset(cached.get(key, ()))]
+        instrumentation.count("label_cache_hits", len(keys) - len(missed))
         for tag in tags_ml:
-            with open("review_classification/classifier for " + tag + ".model", "rb") as model_file:
-                models[tag] = pickle.load(model_file)
-    except FileNotFoundError:
-        vectorizer, models = train_models(tags_ml)
-    vectors = vectorizer.transform(processed_text)
-    for tag, model in models.items():
-        unlabeled_data[tag] = model.predict(vectors)
-        unlabeled_data[tag] = unlabeled_data.apply(
-            lambda review: 0 if (review["Rating"] >= 3 or review.isna()["Body"] or
-                                 review["Body"] == "" or review["Body"] == "Rating provided by a verified purchaser")
-            else review[tag], axis=1
-        )
-    unlabeled_data["Category"] = unlabeled_data.apply(lambda review: " / ".join(
-        (tag for tag in candidate_tags if review[tag] == 1)), axis=1)
+            labels[tag] = np.array([cached[key][tag] if key in cached and tag in cached[key] else 0 for key in keys],
+                                   dtype=int)
+        if missed:
+            with instrumentation.timer("preprocess"):
+                texts = process_texts(unlabeled_data.iloc[missed], workers)
+            with instrumentation.timer("vectorize"):
+                vectors = bundle["vectorizer"].transform(texts)
+            keep = negative[missed] & ~empty_body[missed]
+            with instrumentation.timer("predict"):
+                for tag in tags_ml:
+                    labels[tag][missed] = np.where(keep, bundle["models"][tag].predict(vectors), 0)
+            instrumentation.count("reviews_classified", len(missed))
+            if cache is not None:
+                cache.put_many((keys[i], {tag: int(labels[tag][i]) for tag in tags_ml}) for i in missed)
+    category = np.full(len(unlabeled_data), "", dtype=object)
+    for tag in candidate_tags:
+        unlabeled_data[tag] = labels[tag]
+        hit = labels[tag] == 1
+        category = np.where(hit, np.where(category == "", tag, category + " / " + tag), category)
+    unlabeled_data["Category"] = category
     if one_hot_encoding:
         columns.extend(candidate_tags)
     columns.append("Category")
     return unlabeled_data[columns]
 
 
+def read_chunks(path, chunk_size=10000):
+    """DataFrames of at most chunk_size rows, read one after another from a CSV, xlsx or Parquet file"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        with pd.read_csv(path, chunksize=chunk_size) as reader:
+            yield from reader
+    elif extension == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif extension == ".xlsx":
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            while header is not None:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                yield pd.DataFrame(chunk, columns=header)
+        finally:
+            workbook.close()
+    else:
+        raise ValueError("Unsupported input file {}, expected .csv, .xlsx or .parquet".format(path))
+
+
+def init_worker(tags_ml, path):
+    # workers forked after the parent loaded the bundle find it already in _BUNDLES
+    if tags_ml:
+        load_bundle(tags_ml, path)
+
+
+def classify_chunk(chunk, tags, path=MODEL_BUNDLE):
+    # labels written by an earlier run are replaced
+    return predict_labels(chunk.drop(columns=[*tags, "Category"], errors="ignore"), tags, True, path=path)
+
+
+def classify_files(paths, tags, output, file_format="xlsx", workers=None, chunk_size=10000, path=MODEL_BUNDLE):
+    """Label the reviews of existing files chunk by chunk over a process pool, return the output file and reviews
+
+    Chunks are written in input order as soon as they are labeled, and at most two per worker are read ahead, so the
+    memory used does not depend on the size of the input.
+    """
+    workers = workers or os.cpu_count()
+    tags_ml = [tag for tag in tags if tag not in KEYWORDS_DICT]
+    if tags_ml:
+        load_bundle(tags_ml, path)
+    sink = open_sink(output, file_format)
+    start = time.perf_counter()
+    reviews = 0
+
+    def write(labeled):
+        nonlocal reviews
+        sink.write(labeled)
+        reviews += len(labeled)
+        elapsed = time.perf_counter() - start
+        logging.info("Labeled {} reviews, {:.1f} reviews/sec".format(reviews, reviews / elapsed))
+
+    chunks = (chunk for input_path in paths for chunk in read_chunks(input_path, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(tags_ml, path)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(classify_chunk, chunk, tags, path))
+            if len(pending) >= 2 * workers:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return sink.close(), reviews
+
+
 if __name__ == "__main__":
-    ex_vectorizer, ex_models = train_models(["no cooling", "condensate drain issues"])
+    parser = argparse.ArgumentParser(description="Train and run the review classification models")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="Train the machine learning models into one model bundle")
+    train_parser.add_argument("--tags", type=str, nargs="+", default=["no cooling", "condensate drain issues"],
+                              help="Tags to train classifiers for (default no cooling, condensate drain issues)")
+    train_parser.add_argument("--data", type=str, default="review_classification/training_data.csv",
+                              help="Path of the labeled training data (default review_classification/training_data.csv)")
+    train_parser.add_argument("--bundle", type=str, default=MODEL_BUNDLE,
+                              help="Path of the model bundle (default {})".format(MODEL_BUNDLE))
+    train_parser.add_argument("--incremental", action="store_true",
+                              help="Update the bundle with the labeled rows added since the last update, "
+                                   "in a hashed feature space")
+    train_parser.add_argument("--workers", type=int, default=1,
+                              help="Number of processes preprocessing the review texts (default 1)")
+    classify_parser = commands.add_parser("classify", help="Label the reviews of existing CSV, xlsx or Parquet files")
+    classify_parser.add_argument("inputs", type=str, nargs="+", help="Files of reviews with Title, Body and Rating")
+    classify_parser.add_argument("--tags", type=str, nargs="+", default=TAGs,
+                                 help="Tags to label the reviews with (default all tags of the scrapers)")
+    classify_parser.add_argument("--output", type=str, default="Labeled_Reviews",
+                                 help="Name of output file (default Labeled_Reviews)")
+    classify_parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                                 help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    classify_parser.add_argument("--workers", type=int, default=None,
+                                 help="Number of processes labeling chunks in parallel (default all cores)")
+    classify_parser.add_argument("--chunk_size", type=int, default=10000,
+                                 help="Number of reviews read and labeled at a time (default 10000)")
+    classify_parser.add_argument("--bundle", type=str, default=MODEL_BUNDLE,
+                                 help="Path of the model bundle (default {})".format(MODEL_BUNDLE))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "train":
+        (update_models if args.incremental else train_models)(args.tags, args.data, args.bundle, args.workers)
+        logging.info("Model bundle stored at {}".format(args.bundle))
+    else:
+        START = time.perf_counter()
+        FILE_NAME, REVIEWS = classify_files(args.inputs, args.tags, args.output, args.format, args.workers,
+                                            args.chunk_size, args.bundle)
+        ELAPSED = time.perf_counter() - START
+        logging.info("Labeled {} reviews in {:.1f}s ({:.1f} reviews/sec) into {}".format(
+            REVIEWS, ELAPSED, REVIEWS / ELAPSED if ELAPSED else 0, FILE_NAME))
@@ -0,0 +1,169 @@
+import time
+import zlib
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+import instrumentation
+from review_records import REVIEW_COLUMNS
+from review_classification import process_texts
+
+# Mersenne prime of the universal hash family, every permutation is (a * x + b) % PRIME truncated to 32 bits
+PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def text_of(title, body):
+    return " ".join(text for text in (title, body) if type(text) == str)
+
+
+def exact_key(text):
+    # case and spacing differ between syndicated copies of a review
+    return hashlib.sha256(" ".join(text.lower().split()).encode()).hexdigest()
+
+
+def shingles(text, size=5):
+    # character shingles, so that one word edited in a short review changes only a small share of them
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class ReviewIndex:
+    """Persistent index of the reviews written by earlier runs and by other retailers, finding their duplicates
+
+    A review is a duplicate if its text is identical to an indexed one, or if the Jaccard similarity of the character
+    shingles of their preprocessed texts is at least threshold. Candidates are looked up by locality sensitive hashing
+    of MinHash signatures, every band of the signature is one indexed bucket, so a lookup reads the few reviews sharing
+    a bucket rather than the whole index. The bands are short, 16 of 4 rows, so fewer than 1 in 4000 pairs at 0.8 share
+    none; the similarity of a candidate is then computed from the stored text, as an estimate from 64 permutations is
+    off by 0.05 for one pair in three. Reviews shorter than min_words are never looked up or indexed, as texts like
+    "Works great" are too short to tell a copy from an independent review; within the data of one product, a short
+    review is only a duplicate of an earlier row with the same date, rating, title, body and images.
+
+    New reviews are only stored once commit is called, after the output they were written to is complete.
+    """
+    def __init__(self, path="review_index.sqlite", threshold=0.8, num_perm=64, bands=16, min_words=5, flag=False):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_words = min_words
+        self.flag = flag
+        generator = np.random.RandomState(1)
+        # the permutations are seeded, signatures stored by earlier runs stay comparable
+        self.a = generator.randint(1, (1 << 61) - 1, num_perm, dtype=np.uint64)
+        self.b = generator.randint(0, (1 << 61) - 1, num_perm, dtype=np.uint64)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS reviews (id INTEGER PRIMARY KEY, exact TEXT, "
+                                "retailer TEXT, product TEXT, signature BLOB, added REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS reviews_exact ON reviews (exact)")
+        if "text" not in [column[1] for column in self.connection.execute("PRAGMA table_info(reviews)")]:
+            # indexes written before the texts were kept are compared by their signatures
+            self.connection.execute("ALTER TABLE reviews ADD COLUMN text TEXT")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket BLOB, review INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS buckets_band ON buckets (band, bucket)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS layout (bands INTEGER, rows INTEGER)")
+        if self.connection.execute("SELECT bands, rows FROM layout").fetchone() != (self.bands, self.rows):
+            self.rebuild()
+        self.connection.commit()
+
+    def rebuild(self):
+        # buckets written with other bands are never looked up, so they are cut again from the stored signatures
+        self.connection.execute("DELETE FROM buckets")
+        for review, stored in self.connection.execute("SELECT id, signature FROM reviews "
+                                                      "WHERE signature IS NOT NULL").fetchall():
+            self.add_buckets(review, np.frombuffer(stored, dtype=np.uint32))
+        self.connection.execute("DELETE FROM layout")
+        self.connection.execute("INSERT INTO layout VALUES (?, ?)", (self.bands, self.rows))
+
+    def signature(self, text):
+        hashes = np.array([zlib.crc32(shingle.encode()) for shingle in shingles(text)], dtype=np.uint64)
+        # uint64 products wrap around, which keeps the family universal enough for MinHash
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self.a) + self.b) % PRIME & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def similar(self, signature, text=None):
+        """(retailer, product) of an indexed review similar to the text with the signature, None if there is none"""
+        buckets = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                   for band in range(self.bands)]
+        candidates = self.connection.execute(
+            "SELECT DISTINCT reviews.retailer, reviews.product, reviews.signature, reviews.text FROM buckets "
+            "JOIN reviews ON reviews.id = buckets.review WHERE {}".format(
+                " OR ".join(["(buckets.band = ? AND buckets.bucket = ?)"] * len(buckets))),
+            [value for bucket in buckets for value in bucket]).fetchall()
+        text_shingles = shingles(text) if text is not None else None
+        for retailer, product, stored, stored_text in candidates:
+            if stored_text is not None and text_shingles is not None:
+                stored_shingles = shingles(stored_text)
+                similarity = len(text_shingles & stored_shingles) / len(text_shingles | stored_shingles)
+            else:
+                similarity = np.mean(np.frombuffer(stored, dtype=np.uint32) == signature)
+            if similarity >= self.threshold:
+                return retailer, product
+        return None
+
+    def add(self, exact, signature, retailer, product, text=None):
+        stored = signature.tobytes() if signature is not None else None
+        cursor = self.connection.execute("INSERT INTO reviews (exact, retailer, product, signature, text, added) "
+                                         "VALUES (?, ?, ?, ?, ?, ?)",
+                                         (exact, retailer, product, stored, text, time.time()))
+        if signature is not None:
+            self.add_buckets(cursor.lastrowid, signature)
+
+    def add_buckets(self, review, signature):
+        self.connection.executemany("INSERT INTO buckets VALUES (?, ?, ?)", [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes(), review)
+            for band in range(self.bands)])
+
+    def find(self, data, retailer, product=None):
+        """(retailer, product) of the indexed original of every review of data, None for the reviews indexed now"""
+        product = str(product) if product is not None else None
+        texts = [text_of(title, body) for title, body in zip(data["Title"], data["Body"])]
+        originals = [None] * len(texts)
+        keys = dict()
+        rows = pd.util.hash_pandas_object(data[[column for column in REVIEW_COLUMNS if column in data]], index=False)
+        short_rows = set()
+        for i, (text, row_hash) in enumerate(zip(texts, rows)):
+            if len(text.split()) < self.min_words:
+                if row_hash in short_rows:
+                    originals[i] = (retailer, product)
+                short_rows.add(row_hash)
+                continue
+            keys[i] = exact_key(text)
+            row = self.connection.execute("SELECT retailer, product FROM reviews WHERE exact = ? LIMIT 1",
+                                          (keys[i],)).fetchone()
+            if row is not None:
+                originals[i] = row
+        near = [i for i in keys if originals[i] is None]
+        if near:
+            # only reviews without an identical copy are preprocessed
+            processed = process_texts(data.iloc[near])
+            for i, text in zip(near, processed):
+                # stopwords and digits are gone from the preprocessed text, which can leave too little to compare,
+                # such reviews are only matched by their exact text
+                if len(text.split()) < self.min_words:
+                    self.add(keys[i], None, retailer, product)
+                    continue
+                signature = self.signature(text)
+                originals[i] = self.similar(signature, text)
+                if originals[i] is None:
+                    self.add(keys[i], signature, retailer, product, text)
+        return originals
+
+    @instrumentation.timed("dedup")
+    def dedup(self, data, retailer, product=None):
+        """Drop the duplicates of indexed reviews from data, or flag them in a "Duplicate Of" column"""
+        originals = self.find(data, retailer, product)
+        duplicate = np.array([original is not None for original in originals], dtype=bool)
+        instrumentation.count("duplicates", int(duplicate.sum()))
+        if self.flag:
+            data["Duplicate Of"] = ["{}:{}".format(*original) if original else None for original in originals]
+            return data
+        return data[~duplicate].copy()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,62 @@
+from array import array
+import numpy as np
+import pandas as pd
+
+EPOCH = 719163  # datetime.date(1970, 1, 1).toordinal()
+REVIEW_COLUMNS = ["Date", "Rating", "Title", "Body", "Image"]
+
+
+def constant_column(value, length):
+    """Categorical column repeating value, which is stored once instead of once per row; a plain column of None if
+    value is None, as a categorical without categories has no type to write"""
+    if value is None:
+        return np.full(length, None, dtype=object)
+    return pd.Categorical.from_codes(np.zeros(length, dtype=np.int8), categories=[value])
+
+
+class ReviewBatch:
+    """Reviews of one product, kept column by column until the DataFrame is built
+
+    Dates are kept as days since the epoch and ratings as bytes, so neither is parsed again afterwards. Extra columns
+    are filled per review next to the five common ones, e.g. the model of every Amazon review.
+    """
+    __slots__ = ("dates", "ratings", "titles", "bodies", "images", "extra")
+
+    def __init__(self, extra=()):
+        self.dates = array("i")
+        # -1 marks a missing rating
+        self.ratings = array("b")
+        self.titles, self.bodies, self.images = [], [], []
+        self.extra = {name: [] for name in extra}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def add(self, review_date, rating, title, body, image, *extra):
+        self.dates.append(review_date.toordinal() - EPOCH)
+        self.ratings.append(rating if rating is not None else -1)
+        self.titles.append(title)
+        self.bodies.append(body)
+        self.images.append(image)
+        for values, value in zip(self.extra.values(), extra):
+            values.append(value)
+
+    def frame(self, constants=None, columns=None, categorical=()):
+        """DataFrame of the reviews, with the given constant and extra columns as categoricals
+
+        Dates are datetime64 and ratings int8, or float with NaN if one is missing. The columns default to the
+        constant ones, the common ones and the extra ones, in that order.
+        """
+        ratings = np.array(self.ratings, dtype=np.int8)
+        if (ratings < 0).any():
+            ratings = np.where(ratings < 0, np.nan, ratings)
+        data = {"Date": np.array(self.dates, dtype="datetime64[D]"), "Rating": ratings, "Title": self.titles,
+                "Body": self.bodies, "Image": self.images}
+        constants = constants or dict()
+        for name, values in self.extra.items():
+            data[name] = pd.Categorical(values) if name in categorical else values
+        for name, value in constants.items():
+            data[name] = constant_column(value, len(self))
+        if columns is None:
+            columns = list(constants) + REVIEW_COLUMNS + [name for name in self.extra if name not in constants]
+        return pd.DataFrame(data, columns=columns)
@@ -0,0 +1,64 @@
+import json
+import sqlite3
+import hashlib
+import datetime
+
+
+def review_key(*fields):
+    return hashlib.sha1("\x1f".join("" if field is None else str(field) for field in fields).encode()).hexdigest()
+
+
+class Watermark:
+    def __init__(self, newest=None, keys=()):
+        self.newest = newest
+        self.keys = set(keys)
+        self.seen_newest = newest
+        self.seen_keys = set(keys)
+
+    def reached(self, date, key):
+        # reviews come newest first, so the first one ingested by a previous run ends the pagination
+        if self.newest is None:
+            return False
+        return date < self.newest or (date == self.newest and key in self.keys)
+
+    def observe(self, date, key):
+        if self.seen_newest is None or date > self.seen_newest:
+            self.seen_newest, self.seen_keys = date, {key}
+        elif date == self.seen_newest:
+            self.seen_keys.add(key)
+
+    def changed(self):
+        return self.seen_newest != self.newest or self.seen_keys != self.keys
+
+
+class StateStore:
+    def __init__(self, path="state.sqlite"):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS watermarks (retailer TEXT, product TEXT, newest TEXT, "
+                                "keys TEXT, updated TEXT, PRIMARY KEY (retailer, product))")
+        self.connection.commit()
+        self.staged = dict()
+
+    def watermark(self, retailer, product):
+        row = self.connection.execute("SELECT newest, keys FROM watermarks WHERE retailer = ? AND product = ?",
+                                      (retailer, product)).fetchone()
+        if row is None:
+            return Watermark()
+        return Watermark(datetime.date.fromisoformat(row[0]), json.loads(row[1]))
+
+    def stage(self, retailer, product, watermark):
+        # watermarks are only persisted by commit, after the reviews they cover are written out
+        if watermark is not None and watermark.changed():
+            self.staged[(retailer, product)] = watermark
+
+    def commit(self):
+        updated = datetime.datetime.now().isoformat(timespec="seconds")
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)",
+            [(retailer, product, watermark.seen_newest.isoformat(), json.dumps(sorted(watermark.seen_keys)), updated)
+             for (retailer, product), watermark in self.staged.items()])
+        self.connection.commit()
+        self.staged.clear()
+
+    def close(self):
+        self.connection.close()
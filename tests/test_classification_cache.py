@@ -0,0 +1,11 @@
+import numpy as np
+import pandas as pd
+from classification_cache import content_key
+
+
+def test_content_key_ignores_rating_dtype():
+    # the Rating column of a product is float as soon as one of its ratings is missing
+    ratings = pd.Series([4, None]).astype(float)
+    assert content_key("Title", "Body", np.int8(4), "1") == content_key("Title", "Body", ratings[0], "1")
+    assert content_key("Title", "Body", ratings[1], "1") == content_key("Title", "Body", None, "1")
+    assert content_key("Title", "Body", 4, "1") != content_key("Title", "Body", 5, "1")
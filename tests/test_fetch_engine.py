@@ -0,0 +1,98 @@
+import pytest
+import amazon
+import homedepot
+import http_session
+import rate_limiter
+from driver_pool import LazyDriver
+from fetch_engine import FetchEngine
+from replay import FixtureStore, start_replay
+
+HOMEDEPOT_PAGE = """<html><body>
+<h1 class="page-title">Customer Reviews for Acme 8,000 BTU Window Air Conditioner</h1>
+<h2 class="product-info-bar__detail--24WIp">Internet #1</h2>
+<h2 class="product-info-bar__detail--24WIp">Model #{model}</h2>
+<span class="pager-summary__bold">{page}</span>
+{reviews}
+</body></html>"""
+HOMEDEPOT_REVIEW = """<div class="review_item">
+<span class="stars" style="width: {width}%"></span>
+<span class="review-content__date">Jan {day}, 2024</span>
+<span class="review-content__title">Title {day}</span>
+<div class="review-content-body">Body of review {day}</div>
+</div>"""
+AMAZON_PAGE = """<html><body>{reviews}<ul class="a-pagination"><li class="a-disabled a-last">Next</li></ul></body></html>"""
+AMAZON_REVIEW = """<div data-hook="review" id="R{day}">
+<i data-hook="review-star-rating"><span>{rating}.0 out of 5 stars</span></i>
+<a data-hook="review-title">Title {day}</a>
+<span data-hook="review-date">Reviewed in the United States on January {day}, 2024</span>
+<span data-hook="review-body">Body of review {day}</span>
+</div>"""
+CAPTCHA_PAGE = """<html><body><form action="/errors/validateCaptcha"></form></body></html>"""
+
+
+def save_page(store, url, page):
+    store.save_response("GET", url, None, 200, {"Content-Type": "text/html; charset=utf-8"}, page.encode())
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # replays lift the rate limits of every site, they are restored for the other tests
+    monkeypatch.setattr(rate_limiter, "SITE_LIMITS", {site: dict(limits)
+                                                      for site, limits in rate_limiter.SITE_LIMITS.items()})
+    monkeypatch.setattr(rate_limiter, "_LIMITERS", dict())
+    yield FixtureStore(str(tmp_path))
+    http_session.use_adapter()
+
+
+def test_homedepot_products_replay_concurrently(store):
+    urls = ["https://www.homedepot.com/p/reviews/Acme-AC{}/10{}".format(i, i) for i in range(3)]
+    for i, url in enumerate(urls):
+        reviews = "".join(HOMEDEPOT_REVIEW.format(width=20 * (day % 5 + 1), day=day) for day in range(1, 4 + i))
+        save_page(store, homedepot.REVIEW_PAGE_URL.format(url, 1), HOMEDEPOT_PAGE.format(
+            model="AC{}".format(i), page=1, reviews=reviews))
+        # past the last page the first one is served again
+        save_page(store, homedepot.REVIEW_PAGE_URL.format(url, 2), HOMEDEPOT_PAGE.format(
+            model="AC{}".format(i), page=1, reviews=reviews))
+    start_replay(store.path)
+    engine = FetchEngine(2)
+    outcomes = list(engine.map(lambda url: homedepot.fetch_product(url, engine=engine), [(url,) for url in urls]))
+    assert [error for _, _, error in outcomes] == [None] * 3
+    for i, ((url,), result, _) in enumerate(outcomes):
+        assert len(result) == 3 + i
+        assert set(result["Model No."]) == {"AC{}".format(i)}
+        assert list(result["Title"][:2]) == ["Title 1", "Title 2"]
+        assert list(result["Rating"][:3]) == [2, 3, 4]
+
+
+def test_amazon_product_replays(store, monkeypatch):
+    monkeypatch.setattr(amazon, "size2model", dict(), raising=False)
+    url = "https://www.amazon.com/product-reviews/B000000001"
+    save_page(store, amazon.review_page_url(url, 1), AMAZON_PAGE.format(reviews="".join(
+        AMAZON_REVIEW.format(rating=day, day=day) for day in range(1, 6))))
+    start_replay(store.path)
+    result = amazon.fetch_product(url)
+    assert len(result) == 5
+    assert list(result["Rating"]) == [1, 2, 3, 4, 5]
+    assert str(result["Date"][0].date()) == "2024-01-01"
+
+
+class CaptchaDriver:
+    current_url = "https://www.amazon.com/errors/validateCaptcha"
+    page_source = CAPTCHA_PAGE
+
+    def get(self, url):
+        pass
+
+    def quit(self):
+        pass
+
+
+def test_headless_fallback_fails_on_verification_page(store):
+    url = "https://www.amazon.com/product-reviews/B000000002"
+    save_page(store, amazon.review_page_url(url, 1), CAPTCHA_PAGE)
+    start_replay(store.path)
+    rate_limiter.configure("amazon.com", cooldown=0)
+    with pytest.raises(RuntimeError, match="Verification page in Chrome"):
+        amazon.fetch_product(url, fallback=LazyDriver(CaptchaDriver), interactive=False)
+    with pytest.raises(RuntimeError, match="Verification page at page 1"):
+        amazon.fetch_product(url)
@@ -0,0 +1,45 @@
+import datetime
+import pandas as pd
+import pytest
+from amazon import EXTRA_COLUMNS
+from file_output import open_sink
+from review_records import ReviewBatch
+
+
+def amazon_frame(models, constant=None):
+    batch = ReviewBatch(EXTRA_COLUMNS)
+    for i, model in enumerate(models):
+        batch.add(datetime.date(2024, 1, 1 + i % 28), 5, "Title", "Body", "", model, model, None)
+    constants = {"Model No.": constant, "Model Description": constant} if constant else None
+    return batch.frame(constants, ["Model No.", "Model Description", "Date", "Rating", "Title", "Body", "Image",
+                                   "Badge"], categorical=EXTRA_COLUMNS[:2])
+
+
+@pytest.fixture
+def outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "outputs").mkdir()
+
+
+def test_parquet_after_reviews_without_model(outputs):
+    # reviews without a size strip have no model, which must not fix the type of the column for later products
+    sink = open_sink("reviews", "parquet")
+    sink.write(amazon_frame([None] * 3))
+    sink.write(amazon_frame(["M{}".format(i) for i in range(300)]))
+    sink.write(amazon_frame([None], constant="MX"))
+    result = pd.read_parquet(sink.close())
+    assert len(result) == 304
+    assert result["Model No."].isna().sum() == 3
+    assert list(result["Model No."][-2:]) == ["M299", "MX"]
+    assert result["Date"].iloc[0] == datetime.date(2024, 1, 1)
+
+
+def test_parquet_after_constant_none_model(outputs):
+    sink = open_sink("reviews", "parquet")
+    batch = ReviewBatch()
+    batch.add(datetime.date(2024, 1, 1), 4, "Title", "Body", "")
+    sink.write(batch.frame({"Model No.": None, "Model Description": "Window AC"}))
+    sink.write(batch.frame({"Model No.": "AC1", "Model Description": "Window AC"}))
+    result = pd.read_parquet(sink.close())
+    assert result["Model No."].isna().tolist() == [True, False]
+    assert result["Model No."][1] == "AC1"
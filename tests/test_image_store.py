@@ -0,0 +1,63 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import pytest
+from image_store import ImageStore
+
+IMAGES = {"/a.png": (b"\x89PNG same image", "image/png"), "/b.jpg": (b"\x89PNG same image", "image/jpeg"),
+          "/c.jpg": (b"\xff\xd8 other image", "image/jpeg")}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path not in IMAGES:
+            self.send_error(404)
+            return
+        content, content_type = IMAGES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ImageHandler.requests = []
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def localize(path, base):
+    reviews = pd.DataFrame({"Image": ["\n".join(base + name for name in ("/a.png", "/b.jpg")),
+                                      base + "/c.jpg\n" + base + "/missing.jpg", ""]})
+    store = ImageStore(path, workers=4, retries=0)
+    try:
+        return store.localize(reviews)["Image Files"].tolist()
+    finally:
+        store.close()
+
+
+def test_images_are_stored_once_across_urls_and_runs(tmp_path, server):
+    path = str(tmp_path / "images")
+    files = localize(path, server)
+    shared, other = files[0].split("\n"), files[1].split("\n")
+    # the same content served as png and jpg shares one file, the missing image is left out
+    assert shared[0] == shared[1] and len(other) == 1 and files[2] == ""
+    stored = [name for _, _, names in os.walk(path) for name in names if name != "index.sqlite"]
+    assert len(stored) == 2
+    assert sorted(ImageHandler.requests) == ["/a.png", "/b.jpg", "/c.jpg", "/missing.jpg"]
+    # a second run finds every fetched image in the index and only asks for the missing one again
+    ImageHandler.requests = []
+    assert localize(path, server) == files
+    assert ImageHandler.requests == ["/missing.jpg"]
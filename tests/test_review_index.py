@@ -0,0 +1,19 @@
+import datetime
+import pandas as pd
+from review_index import ReviewIndex
+
+
+def reviews(*rows):
+    return pd.DataFrame([(datetime.date(2024, 1, 1),) + row + ("",) for row in rows],
+                        columns=["Date", "Rating", "Title", "Body", "Image"])
+
+
+def test_short_reviews_only_match_identical_rows_of_the_product(tmp_path):
+    index = ReviewIndex(str(tmp_path / "index.sqlite"))
+    short = (5, "Five Stars", "Works great")
+    assert index.find(reviews(short, short, (4, "Five Stars", "Works great")), "amazon", "A1") == [
+        None, ("amazon", "A1"), None]
+    index.commit()
+    # written independently for another product, or on another day, the same short text is kept
+    assert index.find(reviews(short), "walmart", "W9") == [None]
+    assert index.find(reviews(short), "amazon", "A1") == [None]
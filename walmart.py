@@ -1,16 +1,25 @@
-from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException, ElementNotInteractableException, TimeoutException
 from bs4 import BeautifulSoup
-import requests
 import tqdm
 import pandas as pd
-import time
 import datetime
-import random
 import argparse
 import logging
+import itertools
+from contextlib import closing
 from review_classification import predict_labels
-from file_output import df2excel
+from file_output import open_sink, SINKS
+from fetch_engine import FetchEngine, host_slot, prefetch
+import http_session
+import instrumentation
+from pipeline import add_pipeline_arguments, open_pipeline, close_pipeline
+import rate_limiter
+from state_store import review_key
+from review_records import ReviewBatch, constant_column
+from crawl_journal import CrawlJournal
+from catalog_cache import CatalogCache
+from metadata_cache import MetadataCache
+from driver_pool import LazyDriver, new_driver
 
 URLs = {
     "Window": "https://www.walmart.com/browse/home-improvement/window-air-conditioners/1072864_133032_133026_587566",
@@ -24,49 +33,42 @@ POST_DATA = {"itemId": None, "paginationContext": {"filters": [], "limit": 20, "
 TAGs = ["sound", "no cooling", "condensate drain issues", "8.8 error code", "missing parts", "used unit", "wifi"]
 
 
-def extract(reviews, dates, ratings, titles, bodies, images, earliest=None):
+@instrumentation.timed("extract")
+def extract(reviews, batch, earliest=None, watermark=None):
     if not reviews:
         return False
     for review in reviews:
         date = review["reviewSubmissionTime"]
-        if earliest and datetime.datetime.strptime(date, "%m/%d/%Y").date() < earliest:
+        review_date = datetime.datetime.strptime(date, "%m/%d/%Y").date()
+        if earliest and review_date < earliest:
             return False
-        dates.append(date)
-        ratings.append(review["rating"])
-        titles.append(review.get("reviewTitle", None))
-        bodies.append(review.get("reviewText", None))
-        images.append("\n".join(image["Sizes"]["normal"]["Url"] for image in review["photos"]))
+        if watermark is not None:
+            key = review.get("reviewId") or review_key(date, review.get("reviewTitle"), review.get("reviewText"))
+            if watermark.reached(review_date, key):
+                return False
+            watermark.observe(review_date, key)
+        batch.add(review_date, review["rating"], review.get("reviewTitle", None), review.get("reviewText", None),
+                  "\n".join(image["Sizes"]["normal"]["Url"] for image in review["photos"]))
     return True
 
 
-def parse_product(driver, product_id, url, day_lim=None):
-    url_search = "https://www.walmart.com/terra-firma/fetch?rgs=REVIEWS_MAP"
-    POST_DATA["itemId"] = product_id
-    driver.get(url)
-    time.sleep(0.5 + random.random())
+def parse_metadata(driver, url, interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    limiter.acquire()
+    with instrumentation.timer("browser_load"):
+        driver.get(url)
     page = driver.page_source
     soup = BeautifulSoup(page, "html.parser")
     model_description = soup.find("h1").text
     if "verify" in model_description.lower():
+        limiter.report_blocked()
+        # nobody can complete the verification in a headless browser, so the product fails instead of waiting
+        if not interactive:
+            raise RuntimeError("Verification page in Chrome: {}".format(url))
         _ = input("Complete verification and press ENTER to proceed")
         page = driver.page_source
         soup = BeautifulSoup(page, "html.parser")
         model_description = soup.find("h1").text
-    earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
-    dates, ratings, titles, bodies, images = [], [], [], [], []
-    page_no = 1
-    to_continue = True
-    while to_continue:
-        POST_DATA["paginationContext"]["page"] = page_no
-        result = requests.post(url_search, headers=HEADERS, json=POST_DATA, timeout=5)
-        if result.status_code == 200:
-            reviews = result.json()["payload"]["reviews"][product_id]["customerReviews"]
-            to_continue = extract(reviews, dates, ratings, titles, bodies, images, earliest)
-            page_no += 1
-        else:
-            raise Exception
-        time.sleep(1 + random.random())
-    result = pd.DataFrame({"Date": dates, "Rating": ratings, "Title": titles, "Body": bodies, "Image": images})
 
     model_no = url
     tables = pd.read_html(page)
@@ -82,42 +84,111 @@ def parse_product(driver, product_id, url, day_lim=None):
         if feature == "Model":
             model_no = item
             break
-    result["Model No."] = model_no
-    result["Model Description"] = model_description
-    result["Manufacturer"] = model_description.split()[0]
+    return model_no, model_description
+
+
+def load_metadata(browser, product_id, url, cache=None, interactive=True):
+    # browser is only called to launch or reuse a driver when the product is not cached
+    metadata = cache.get("walmart", product_id) if cache is not None else None
+    if metadata is None:
+        metadata = parse_metadata(browser(), url, interactive)
+        if cache is not None:
+            cache.put("walmart", product_id, *metadata)
+    return metadata
+
+
+@instrumentation.timed_product("walmart", 0)
+def fetch_reviews(product_id, day_lim=None, engine=None, retries=5, watermark=None, depth=1):
+    url_search = "https://www.walmart.com/terra-firma/fetch?rgs=REVIEWS_MAP"
+    earliest = datetime.date.today() - datetime.timedelta(days=day_lim) if day_lim else None
+    batch = ReviewBatch()
+    budget = http_session.RetryBudget(retries)
+    limiter = rate_limiter.get_limiter(url_search)
+
+    def fetch_page(page_no):
+        post_data = dict(POST_DATA, itemId=product_id,
+                         paginationContext=dict(POST_DATA["paginationContext"], page=page_no))
+        result = http_session.post(url_search, budget, limiter, host_slot(engine, url_search), headers=HEADERS,
+                                   json=post_data, timeout=5)
+        return result.json()["payload"]["reviews"][product_id]["customerReviews"]
+
+    # page numbers are known ahead, so up to depth pages are requested before the previous ones are extracted
+    with closing(prefetch(fetch_page, itertools.count(1), depth)) as pages:
+        for reviews in pages:
+            if not extract(reviews, batch, earliest, watermark):
+                break
+    return batch.frame()
+
+
+def build_result(result, model_no, model_description):
+    result["Model No."] = constant_column(model_no, len(result))
+    result["Model Description"] = constant_column(model_description, len(result))
+    result["Manufacturer"] = constant_column(model_description.split()[0], len(result))
     return result[["Manufacturer", "Model No.", "Model Description", "Date", "Rating", "Title", "Body", "Image"]]
 
 
-def parse_content(driver, url, keyword):
-    driver.get(url)
+def open_browser():
+    driver = new_driver()
+    _ = input("Press ENTER to proceed")
+    return driver
+
+
+def finish_result(result, predict=False, cache=None, index=None, product=None, images=None):
+    if index is not None:
+        result = index.dedup(result, "walmart", product)
+    if images is not None and len(result) > 0:
+        result = images.localize(result)
+    return predict_labels(result, TAGs, True, cache=cache) if predict and len(result) > 0 else result
+
+
+def page_items(driver, keyword):
+    items = set()
+    for item in driver.find_elements_by_class_name("Grid-col.u-size-6-12.u-size-1-4-m.u-size-1-5-xl"):
+        try:
+            item.find_element_by_class_name("stars-reviews-count")
+            hyperlink = item.find_elements_by_tag_name("a")[1]
+            desc = hyperlink.find_element_by_tag_name("span").text
+            if keyword.lower() not in desc.lower():
+                continue
+            product_id = item.find_element_by_class_name("search-result-gridview-item-wrapper") \
+                .get_attribute("data-id")
+            product_url = hyperlink.get_attribute("href")
+            items.add((product_id, product_url))
+        except NoSuchElementException:
+            pass
+    return items
+
+
+def first_page(driver, url, keyword):
+    limiter = rate_limiter.get_limiter(url)
+    limiter.acquire()
+    with instrumentation.timer("browser_load"):
+        driver.get(url)
     # _ = input("Press ENTER to proceed")  # uncomment this is verification needed at the first page
-    time.sleep(2 + random.random())
-    target_items = set()
+    limiter.acquire()
+    return page_items(driver, keyword)
+
+
+def parse_content(driver, url, keyword, interactive=True):
+    limiter = rate_limiter.get_limiter(url)
+    target_items = first_page(driver, url, keyword)
     while True:
-        for item in driver.find_elements_by_class_name("Grid-col.u-size-6-12.u-size-1-4-m.u-size-1-5-xl"):
-            try:
-                item.find_element_by_class_name("stars-reviews-count")
-                hyperlink = item.find_elements_by_tag_name("a")[1]
-                desc = hyperlink.find_element_by_tag_name("span").text
-                if keyword.lower() not in desc.lower():
-                    continue
-                product_id = item.find_element_by_class_name("search-result-gridview-item-wrapper") \
-                    .get_attribute("data-id")
-                product_url = hyperlink.get_attribute("href")
-                target_items.add((product_id, product_url))
-            except NoSuchElementException:
-                pass
         try:
             next_link = driver.find_element_by_class_name(
                 "elc-icon.paginator-hairline-btn.paginator-btn.paginator-btn-next")
         except NoSuchElementException:
             break
-        time.sleep(1 + random.random())
+        limiter.acquire()
         try:
             next_link.click()
+            limiter.report()
         except ElementNotInteractableException:
+            limiter.report_blocked()
+            if not interactive:
+                raise RuntimeError("Verification page in Chrome: {}".format(driver.current_url))
             _ = input("Complete verification and press ENTER to proceed")
-        time.sleep(1 + random.random())
+        limiter.acquire()
+        target_items |= page_items(driver, keyword)
     return target_items
 
 
@@ -130,49 +201,135 @@ if __name__ == "__main__":
     parser.add_argument("--days", type=int, default=7, help="Limit of days before today (default 7)")
     parser.add_argument("--predict_labels", action="store_true", help="Indicate labels prediction")
     parser.add_argument("--output", type=str, default="Walmart_Reviews",
-                        help="Name of output .xlsx file (default Walmart_Reviews)")
+                        help="Name of output file (default Walmart_Reviews)")
+    parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                        help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of products fetched concurrently (default 1)")
+    parser.add_argument("--host_workers", type=int, default=None,
+                        help="Limit of concurrent requests per host (default same as --workers)")
+    parser.add_argument("--pool_size", type=int, default=None,
+                        help="Size of the keep-alive connection pool per host "
+                             "(default --workers times --prefetch, at least 10)")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="Number of review pages of one product requested ahead (default 1)")
+    parser.add_argument("--retries", type=int, default=5, help="Limit of retries per product (default 5)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Initial requests per second to Walmart, adapted to the responses (default 0.6)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the interrupted crawl of the category without refetching finished products")
+    parser.add_argument("--journal", type=str, default="journal.sqlite",
+                        help="Path of the checkpoint journal of category crawls (default journal.sqlite)")
+    parser.add_argument("--catalog", type=str, default="catalog.sqlite",
+                        help="Path of the cache of products found in each category (default catalog.sqlite)")
+    parser.add_argument("--catalog_ttl", type=float, default=24,
+                        help="Hours the products found in a category are reused, 0 to always search (default 24)")
+    parser.add_argument("--check_first_page", action="store_true",
+                        help="Search the category again if its first listing page changed since it was cached")
+    parser.add_argument("--metadata", type=str, default="metadata.sqlite",
+                        help="Path of the cache of product descriptions and model numbers (default metadata.sqlite)")
+    parser.add_argument("--metadata_ttl", type=float, default=168,
+                        help="Hours the description and model number of a product are reused (default 168)")
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
-    DRIVER = webdriver.Chrome("./chromedriver")
-    DRIVER.set_page_load_timeout(10)
-    _ = input("Press ENTER to proceed")
+    STATE, CACHE, INDEX, IMAGES = open_pipeline(args, args.predict_labels)
+    if args.rate:
+        rate_limiter.configure("walmart.com", rate=args.rate)
+    http_session.configure(args.pool_size or max(args.workers * args.prefetch, http_session.POOL_SIZE))
+    # every product is written out as soon as it is complete instead of concatenating all of them at the end
+    SINK = open_sink(args.output, args.format)
+    METADATA = MetadataCache(args.metadata, args.metadata_ttl * 3600)
+    # the browser is only launched once a page has to be loaded, cached products are fetched over HTTP alone
+    DRIVER = LazyDriver(open_browser)
     if args.mode == "category" and args.category in URLs:
         logging.basicConfig(level=logging.INFO, filename="logging.log", filemode="w")
         URL = URLs[args.category]
-        targets = parse_content(DRIVER, URL, args.category)
+        JOURNAL = CrawlJournal("walmart", args.category, args.journal, args.resume)
+        targets = JOURNAL.targets()
+        if targets is None:
+            CATALOG = CatalogCache(args.catalog, args.catalog_ttl * 3600)
+            FIRST_PAGE = first_page(DRIVER(), URL, args.category) if args.check_first_page else None
+            targets = CATALOG.get("walmart", args.category, FIRST_PAGE)
+            if targets is None:
+                targets = parse_content(DRIVER(), URL, args.category)
+                CATALOG.put("walmart", args.category, targets, FIRST_PAGE)
+            CATALOG.close()
+            JOURNAL.save_targets(targets)
         logging.info("Found {} products".format(len(targets)))
-        results = []
-        for target_id, target_url in tqdm.tqdm(targets):
-            logging.info("Getting product ID {}".format(target_id))
+        done = JOURNAL.completed()
+        for target_id, (result, watermark) in done.items():
+            if STATE:
+                STATE.stage("walmart", target_id, watermark)
+            if len(result) > 0:
+                SINK.write(finish_result(result, args.predict_labels, CACHE, INDEX, target_id, IMAGES))
+        if done:
+            logging.info("Resumed {} finished products".format(len(done)))
+
+        def record_product(target_id, target_url, metadata, watermark, future):
             try:
-                results.append(parse_product(DRIVER, target_id, target_url, args.days))
-                if results[-1] is not None and len(results[-1]) > 0:
-                    logging.info("Success: {}, extracted {} reviews".format(results[-1].iloc[0, 2], len(results[-1])))
+                result = build_result(future.result(), *metadata)
+                JOURNAL.complete(target_id, result, watermark)
+                if STATE:
+                    STATE.stage("walmart", target_id, watermark)
+                if len(result) > 0:
+                    logging.info("Success: {}, extracted {} reviews".format(result.iloc[0, 2], len(result)))
+                    SINK.write(finish_result(result, args.predict_labels, CACHE, INDEX, target_id, IMAGES))
                 else:
                     logging.warning("No new reviews: {}".format(target_url))
-            except TimeoutException:
-                logging.error("Timeout: {}".format(target_url))
-                DRIVER.quit()
-                DRIVER = webdriver.Chrome("./chromedriver")
-                DRIVER.set_page_load_timeout(10)
             except Exception:
                 logging.error("Failed: {}".format(target_url))
-        DRIVER.quit()
-        final = pd.concat(results)
+
+        # the browser only loads product pages, review pages of loaded products are fetched by the engine meanwhile
+        with FetchEngine(args.workers, args.host_workers) as engine:
+            pending = []
+            for target_id, target_url in tqdm.tqdm(targets):
+                if target_id in done:
+                    continue
+                logging.info("Getting product ID {}".format(target_id))
+                try:
+                    metadata = load_metadata(DRIVER, target_id, target_url, METADATA)
+                except TimeoutException:
+                    logging.error("Timeout: {}".format(target_url))
+                    DRIVER.close()
+                    DRIVER = LazyDriver(new_driver)
+                    continue
+                except Exception:
+                    logging.error("Failed: {}".format(target_url))
+                    continue
+                watermark = STATE.watermark("walmart", target_id) if STATE else None
+                pending.append((target_id, target_url, metadata, watermark, engine.submit(
+                    fetch_reviews, target_id, args.days, engine, args.retries, watermark, args.prefetch)))
+                # finished products are checkpointed while the browser moves on, in the order of the targets
+                while pending and pending[0][-1].done():
+                    record_product(*pending.pop(0))
+            for item in pending:
+                record_product(*item)
+        DRIVER.close()
     elif args.mode == "product":
         logging.basicConfig(level=logging.INFO)
-        final = parse_product(DRIVER, args.productID, args.productURL, args.days)
-        DRIVER.quit()
+        WATERMARK = STATE.watermark("walmart", args.productID) if STATE else None
+        MODEL_NO, MODEL_DESCRIPTION = load_metadata(DRIVER, args.productID, args.productURL, METADATA)
+        REVIEWS = fetch_reviews(args.productID, args.days, retries=args.retries, watermark=WATERMARK,
+                                depth=args.prefetch)
+        final = build_result(REVIEWS, MODEL_NO, MODEL_DESCRIPTION)
+        DRIVER.close()
+        if STATE:
+            STATE.stage("walmart", args.productID, WATERMARK)
         if final is None or len(final) == 0:
             logging.warning("No new reviews: {}".format(args.productURL))
             quit()
         logging.info("Success, extracted {} reviews".format(len(final)))
+        SINK.write(finish_result(final, args.predict_labels, CACHE, INDEX, args.productID, IMAGES))
     else:
-        DRIVER.quit()
-        final = None
         logging.error("Invalid mode or category")
         quit()
-    final["Date"] = pd.to_datetime(final["Date"], format="%m/%d/%Y").map(lambda dt: dt.date())
-    if args.predict_labels:
-        final = predict_labels(final, TAGs, True)
-    file_name = df2excel(final, args.output)
+    METADATA.close()
+    file_name = SINK.close()
+    close_pipeline(INDEX, IMAGES, STATE)
+    # the journal is only dropped once the output and the watermarks are persisted
+    if args.mode == "category":
+        JOURNAL.clear()
+        JOURNAL.close()
+    if file_name is None:
+        logging.warning("No new reviews")
+        quit()
     logging.info("Process completed! File stored at {}".format(file_name))
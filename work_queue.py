@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import pickle
+import socket
+import sqlite3
+import logging
+import argparse
+import functools
+import importlib
+import threading
+import multiprocessing
+from driver_pool import LazyDriver, new_driver, is_alive
+from file_output import open_sink, SINKS
+from metadata_cache import MetadataCache
+from orchestrator import discover, TAGs
+from review_classification import predict_labels
+from pipeline import add_output_arguments, open_outputs, close_pipeline
+
+
+class WorkQueue:
+    def __init__(self, path="queue.sqlite", lease=600, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, queue TEXT, payload TEXT, "
+                           "state TEXT, attempts INTEGER, worker TEXT, lease_until REAL, result BLOB, error TEXT, "
+                           "updated REAL, UNIQUE (queue, payload))")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (queue, state, lease_until)")
+
+    def connection(self):
+        # every thread gets its own connection, workers in other processes share the file; WAL mode needs shared
+        # memory, so they must run on the same host, and the file must not be on a network filesystem
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def put(self, queue, payloads):
+        """Add jobs to the queue, a payload already queued is not added twice; return the number added"""
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.executemany(
+                "INSERT OR IGNORE INTO jobs (queue, payload, state, attempts, updated) VALUES (?, ?, 'pending', 0, ?)",
+                [(queue, json.dumps(payload, sort_keys=True), now) for payload in payloads])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    def claim(self, queue, worker, n=1):
+        """Lease up to n pending jobs to worker, jobs whose lease expired are pending again until max_attempts"""
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # a job that crashed or hung its worker counts as failed, otherwise it would be leased again forever
+            connection.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                               "worker = NULL, error = 'Lease expired', updated = ? "
+                               "WHERE queue = ? AND state = 'leased' AND lease_until < ?",
+                               (self.max_attempts, now, queue, now))
+            rows = connection.execute("SELECT id, payload FROM jobs WHERE queue = ? AND state = 'pending' "
+                                      "ORDER BY id LIMIT ?", (queue, n)).fetchall()
+            connection.executemany("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                                   "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                   [(worker, now + self.lease, now, job_id) for job_id, _ in rows])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [(job_id, json.loads(payload)) for job_id, payload in rows]
+
+    def renew(self, job_id, worker):
+        """Extend the lease of a running job, False if the lease was lost to another worker"""
+        cursor = self.connection().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + self.lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        cursor = self.connection().execute(
+            "UPDATE jobs SET state = 'done', result = ?, error = NULL, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (pickle.dumps(result, pickle.HIGHEST_PROTOCOL), time.time(), job_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        # retried by the next claim until max_attempts, then left as failed
+        cursor = self.connection().execute(
+            "UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, worker = NULL, "
+            "error = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, str(error), time.time(), job_id, worker))
+        return cursor.rowcount == 1
+
+    def counts(self, queue):
+        rows = self.connection().execute("SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state",
+                                         (queue,)).fetchall()
+        return dict(rows)
+
+    def results(self, queue):
+        """Yield (payload, result) of every finished job"""
+        rows = self.connection().execute("SELECT payload, result FROM jobs WHERE queue = ? AND state = 'done' "
+                                         "ORDER BY id", (queue,))
+        for payload, result in rows:
+            yield json.loads(payload), pickle.loads(result)
+
+    def clear(self, queue):
+        self.connection().execute("DELETE FROM jobs WHERE queue = ?", (queue,))
+
+    def close(self):
+        if getattr(self.local, "connection", None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+
+def keep_leased(queue, job_id, worker, stop):
+    while not stop.wait(queue.lease / 3):
+        if not queue.renew(job_id, worker):
+            logging.warning("Lost the lease of job {}".format(job_id))
+            break
+    queue.close()
+
+
+def payloads(retailer, input_name=None, category=None):
+    """Jobs of the products in a JSON input file (Lowe's, Amazon) or found in a category (Walmart, Homedepot)"""
+    if retailer in ("lowes", "amazon"):
+        with open((input_name or retailer + "_input") + ".json") as f:
+            data = json.load(f)
+        if retailer == "lowes":
+            return [{"model": model, "description": data["model2desc"][model], "url": url}
+                    for model, urls in data["urls"].items() for url in urls]
+        urls = data["urls"][category]
+        targets = [(urls, None)] if type(urls) == str else [(url, model) for model, url in urls.items()]
+        return [{"url": url, "model": model} for url, model in targets]
+    module = importlib.import_module(retailer)
+    browser = LazyDriver(new_driver)
+    try:
+        if retailer == "walmart":
+            targets = discover("walmart", {"category": category}, browser,
+                               lambda driver, category_: module.parse_content(driver, module.URLs[category_],
+                                                                              category_))
+            return [{"product_id": product_id, "url": url} for product_id, url in targets]
+        targets = discover("homedepot", {"category": category}, browser,
+                           lambda driver, category_: module.parse_content(driver, module.URLs[category_]))
+        return [{"url": "https://www.homedepot.com/p/reviews" + target[2:]} for target in targets]
+    finally:
+        browser.close()
+
+
+class JobRunner:
+    """Run one queued product with the product functions of its retailer"""
+    def __init__(self, retailer, days=7, input_name=None, engine="selenium", headless=False):
+        self.retailer = retailer
+        self.module = importlib.import_module(retailer)
+        self.days = days
+        self.engine = engine
+        self.browser = LazyDriver(functools.partial(new_driver, headless))
+        self.interactive = not headless
+        self.metadata = None
+        if retailer == "lowes":
+            self.module.model2desc = dict()
+        elif retailer == "amazon":
+            with open((input_name or "amazon_input") + ".json") as f:
+                data = json.load(f)
+            self.module.size2model, self.module.model2desc = data["size2model"], data["model2desc"]
+        elif retailer == "walmart":
+            self.metadata = MetadataCache()
+
+    def __call__(self, payload):
+        try:
+            return self.run(payload)
+        except Exception:
+            # a broken browser is relaunched for the next job
+            if self.browser.driver is not None and not is_alive(self.browser.driver):
+                self.browser.close()
+            raise
+
+    def run(self, payload):
+        if self.retailer == "lowes":
+            self.module.model2desc[payload["model"]] = payload["description"]
+            return self.module.parse_product(payload["model"], payload["url"], self.days)
+        if self.retailer == "walmart":
+            model = self.module.load_metadata(self.browser, payload["product_id"], payload["url"], self.metadata,
+                                              self.interactive)
+            return self.module.build_result(self.module.fetch_reviews(payload["product_id"], self.days), *model)
+        if self.retailer == "homedepot":
+            if self.engine == "http":
+                return self.module.fetch_product(payload["url"], self.days, fallback=self.browser,
+                                                 interactive=self.interactive)
+            return self.module.parse_product(self.browser(), payload["url"], self.days,
+                                             interactive=self.interactive)
+        if self.engine == "http":
+            return self.module.fetch_product(payload["url"], payload["model"], self.days, fallback=self.browser,
+                                             interactive=self.interactive)
+        return self.module.parse_product(self.browser(), payload["url"], payload["model"], self.days,
+                                         interactive=self.interactive)
+
+    def close(self):
+        self.browser.close()
+        if self.metadata is not None:
+            self.metadata.close()
+
+
+def collect(queue, retailer, output, file_format="xlsx", predict=False, index=None, images=None):
+    """Write the reviews of every finished job into one output file, return its name or None"""
+    sink = open_sink(output, file_format)
+    for payload, result in queue.results(retailer):
+        if result is None or len(result) == 0:
+            continue
+        if index is not None:
+            result = index.dedup(result, retailer, payload.get("product_id", payload["url"]))
+        if len(result) == 0:
+            continue
+        if images is not None:
+            result = images.localize(result)
+        sink.write(predict_labels(result, TAGs, True) if predict else result)
+    file_name = sink.close()
+    # the reviews are only indexed as written once the output is complete
+    if index is not None:
+        index.commit()
+    return file_name
+
+
+def run_worker(path, retailer, days, lease, options, poll=5.0):
+    """Claim and run jobs of retailer until its queue has no pending or leased jobs left"""
+    queue = WorkQueue(path, lease)
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    run = JobRunner(retailer, days, **options)
+    try:
+        while True:
+            claimed = queue.claim(retailer, worker)
+            if not claimed:
+                counts = queue.counts(retailer)
+                if not counts.get("pending") and not counts.get("leased"):
+                    break
+                # jobs leased by other workers come back if their lease expires
+                time.sleep(poll)
+                continue
+            job_id, payload = claimed[0]
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=keep_leased, args=(queue, job_id, worker, stop), daemon=True)
+            heartbeat.start()
+            try:
+                result = run(payload)
+            except Exception as error:
+                logging.error("Failed: {} ({})".format(payload, error))
+                queue.fail(job_id, worker, error)
+            else:
+                logging.info("Success: {}, extracted {} reviews".format(
+                    payload, len(result) if result is not None else 0))
+                queue.complete(job_id, worker, result)
+            finally:
+                stop.set()
+                heartbeat.join()
+    finally:
+        run.close()
+        queue.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl products through a durable work queue shared by workers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    enqueue_parser = commands.add_parser("enqueue", help="Queue the products of a JSON input file or a category")
+    work_parser = commands.add_parser("work", help="Claim and extract queued products until none is left")
+    collect_parser = commands.add_parser("collect", help="Write the extracted reviews into one output file")
+    for command_parser in (enqueue_parser, work_parser, collect_parser):
+        command_parser.add_argument("--queue", type=str, default="queue.sqlite",
+                                    help="Path of the queue database, shared by all workers (default queue.sqlite)")
+        command_parser.add_argument("--retailer", type=str, required=True,
+                                    help="Retailer of the jobs (lowes/walmart/homedepot/amazon)")
+    enqueue_parser.add_argument("--input", type=str, default=None,
+                                help="Name of the .json input file for Lowe's and Amazon")
+    enqueue_parser.add_argument("--category", type=str, default=None, help="Category of products")
+    work_parser.add_argument("--days", type=int, default=7, help="Limit of days before today (default 7)")
+    work_parser.add_argument("--processes", type=int, default=1,
+                             help="Number of worker processes started on this host (default 1)")
+    work_parser.add_argument("--lease", type=float, default=600,
+                             help="Seconds a claimed job is reserved for a worker without a heartbeat (default 600)")
+    work_parser.add_argument("--input", type=str, default=None, help="Name of the .json input file for Amazon")
+    work_parser.add_argument("--engine", type=str, default="selenium",
+                             help="Load Homedepot/Amazon review pages with selenium/http (default selenium)")
+    work_parser.add_argument("--headless", action="store_true", help="Run the Chrome drivers headless")
+    collect_parser.add_argument("--predict_labels", action="store_true", help="Indicate labels prediction")
+    collect_parser.add_argument("--output", type=str, default="Queued_Reviews",
+                                help="Name of output file (default Queued_Reviews)")
+    collect_parser.add_argument("--format", type=str, default="xlsx", choices=SINKS,
+                                help="Format of output file, xlsx/csv/parquet (default xlsx)")
+    collect_parser.add_argument("--clear", action="store_true", help="Remove the retailer's jobs once written")
+    add_output_arguments(collect_parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    if args.command == "enqueue":
+        QUEUE = WorkQueue(args.queue)
+        ADDED = QUEUE.put(args.retailer, payloads(args.retailer, args.input, args.category))
+        logging.info("Queued {} new jobs, {}".format(ADDED, QUEUE.counts(args.retailer)))
+        QUEUE.close()
+    elif args.command == "work":
+        OPTIONS = {"input_name": args.input, "engine": args.engine, "headless": args.headless}
+        WORKERS = [multiprocessing.Process(target=run_worker,
+                                           args=(args.queue, args.retailer, args.days, args.lease, OPTIONS))
+                   for _ in range(max(1, args.processes))]
+        for process in WORKERS:
+            process.start()
+        for process in WORKERS:
+            process.join()
+        QUEUE = WorkQueue(args.queue)
+        logging.info("Queue {}: {}".format(args.retailer, QUEUE.counts(args.retailer)))
+        QUEUE.close()
+    else:
+        QUEUE = WorkQueue(args.queue)
+        INDEX, IMAGES = open_outputs(args)
+        file_name = collect(QUEUE, args.retailer, args.output, args.format, args.predict_labels, INDEX, IMAGES)
+        close_pipeline(INDEX, IMAGES)
+        if file_name is None:
+            logging.warning("No reviews extracted")
+        else:
+            logging.info("Process completed! File stored at {}".format(file_name))
+            if args.clear:
+                QUEUE.clear(args.retailer)
+        QUEUE.close()